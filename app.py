@@ -1,22 +1,185 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from io import StringIO
+from flask import Flask, render_template, request, redirect, url_for, flash, g, jsonify, make_response, abort, has_request_context
+from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user, login_url
+from io import TextIOWrapper
 import sqlite3
+import threading
+import time
+import json
+import hashlib
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from db import ConnectionPool, DEFAULT_PRAGMAS, transaction, savepoint
+from cache import LRUCache
+from recipe_matrix import RecipeMatrix
+from periods import week_start, week_bounds, week_month, period_for_date, current_period
+from sales_import import FORMATS, detect_format, iter_rows, parse_sale, parse_delivery, chunked
+from reports import REPORT_FORMATS, render_daily_report, render_sales_report
+from forecast import forecast_items, history_days, reorder_list
+from jobs import JobQueue, QueueFull, JOBS_TABLE, JOBS_INDEX
+from migrations import migrate
+from app_logging import logger, setup_logging
+from instrumentation import InstrumentedConnection, init_instrumentation, metrics
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this to a secure random key in production
 
+# Logging: LOG_FORMAT is 'text' or 'json'
+app.config.setdefault('LOG_LEVEL', os.environ.get('BAKERS_LOG_LEVEL', 'INFO'))
+app.config.setdefault('LOG_FORMAT', os.environ.get('BAKERS_LOG_FORMAT', 'text'))
+setup_logging(app)
+
+# Opt-in request/SQL instrumentation; PROFILE_SAMPLE_RATE of requests also get a cProfile dump in PROFILE_DIR
+app.config.setdefault('INSTRUMENTATION', os.environ.get('BAKERS_INSTRUMENTATION', '0') == '1')
+app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('BAKERS_PROFILE_SAMPLE_RATE', 0)))
+app.config.setdefault('PROFILE_DIR', os.environ.get('BAKERS_PROFILE_DIR', 'profiles'))
+if app.config['INSTRUMENTATION']:
+    init_instrumentation(app)
+
 # Database setup
-DB_NAME = 'baker_inventory.db'
+DB_NAME = os.environ.get('BAKERS_DB_NAME', 'baker_inventory.db')
+app.config.setdefault('DB_NAME', DB_NAME)
+app.config.setdefault('DB_POOL_SIZE', int(os.environ.get('BAKERS_DB_POOL_SIZE', 5)))
+app.config.setdefault('DB_PRAGMAS', dict(DEFAULT_PRAGMAS))
+# Optional per-business database files. When set, each business's data lives in
+# SHARD_DIR/business_<id>.db and DB_NAME keeps only the directory of businesses
+# and users, so one bakery's writes never wait on another's write lock.
+app.config.setdefault('SHARD_DIR', os.environ.get('BAKERS_SHARD_DIR', ''))
+
+app.config.setdefault('RECIPE_CACHE_SIZE', int(os.environ.get('BAKERS_RECIPE_CACHE_SIZE', 256)))
+app.config.setdefault('USER_CACHE_SIZE', int(os.environ.get('BAKERS_USER_CACHE_SIZE', 1024)))
+app.config.setdefault('USER_CACHE_TTL', float(os.environ.get('BAKERS_USER_CACHE_TTL', 60)))
+app.config.setdefault('IMPORT_CHUNK_SIZE', int(os.environ.get('BAKERS_IMPORT_CHUNK_SIZE', 5000)))
+app.config.setdefault('REPORT_CACHE_SIZE', int(os.environ.get('BAKERS_REPORT_CACHE_SIZE', 256)))
+# Weeks averaged by the demand forecast, and the safety margin added to reorders
+app.config.setdefault('FORECAST_WINDOW', int(os.environ.get('BAKERS_FORECAST_WINDOW', 4)))
+app.config.setdefault('FORECAST_SAFETY', float(os.environ.get('BAKERS_FORECAST_SAFETY', 0.1)))
+# Hours a stored /api/sales response is replayed for a retried Idempotency-Key
+app.config.setdefault('IDEMPOTENCY_KEY_TTL', float(os.environ.get('BAKERS_IDEMPOTENCY_KEY_TTL', 24)))
+# Background job threads (0 runs jobs only via `flask run-jobs`), and the queue
+# depth past which sales do their follow-up work inline instead of queueing it
+app.config.setdefault('JOB_WORKERS', int(os.environ.get('BAKERS_JOB_WORKERS', 2)))
+app.config.setdefault('JOB_MAX_PENDING', int(os.environ.get('BAKERS_JOB_MAX_PENDING', 1000)))
+app.config.setdefault('JOB_MAX_ATTEMPTS', int(os.environ.get('BAKERS_JOB_MAX_ATTEMPTS', 3)))
+
+_pools = {}
+_pools_lock = threading.Lock()
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+def get_pool(path=None):
+    path = path or app.config['DB_NAME']
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path, size=app.config['DB_POOL_SIZE'], pragmas=app.config['DB_PRAGMAS'],
+                                                     factory=InstrumentedConnection if app.config['INSTRUMENTATION'] else sqlite3.Connection)
+    return pool
+
+def db_path(business_id=None):
+    if business_id is None or not app.config['SHARD_DIR']:
+        return app.config['DB_NAME']
+    return os.path.join(app.config['SHARD_DIR'], f"business_{int(business_id)}.db")
+
+def current_business_id():
+    # Set explicitly with use_business() outside requests (CLI commands, jobs),
+    # otherwise the logged-in user's business
+    if 'business_id' in g:
+        return g.business_id
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.business_id
+    return None
+
+@contextmanager
+def use_business(business_id):
+    # Routes get_db() to business_id's database for the enclosed block;
+    # None means the directory database
+    nested, previous = 'business_id' in g, g.get('business_id')
+    g.business_id = business_id
+    try:
+        yield
+    finally:
+        if nested:
+            g.business_id = previous
+        else:
+            g.pop('business_id', None)
+
+def tenant_scopes():
+    # Businesses to visit for work that spans every database: [None] (just
+    # DB_NAME) unless sharded, else each business with a shard file
+    if not app.config['SHARD_DIR']:
+        return [None]
+    return [business_id for business_id in get_businesses() if os.path.exists(db_path(business_id))]
+
+def _connection(path):
+    # One pooled connection per database file per app context, shared by every helper in the request
+    connections = g.setdefault('dbs', {})
+    conn = connections.get(path)
+    if conn is None:
+        if path != app.config['DB_NAME']:
+            # Pools are bounded, so every context takes the directory before a
+            # shard; two threads taking them in opposite orders could deadlock
+            get_directory_db()
+        conn = connections[path] = get_pool(path).acquire()
+        if path not in _schema_ready:
+            with _schema_lock:
+                if path not in _schema_ready:
+                    ensure_schema(conn, path)
+                    _schema_ready.add(path)
+                    # Once per process, so a missing index shows up in the logs of any entry point
+                    if path == app.config['DB_NAME']:
+                        audit_query_plans(conn)
+    return conn
+
+def get_db():
+    return _connection(db_path(current_business_id()))
+
+def get_directory_db():
+    # Businesses and users always live in DB_NAME
+    return _connection(app.config['DB_NAME'])
+
+@app.teardown_appcontext
+def release_db(exception):
+    for path, conn in g.pop('dbs', {}).items():
+        get_pool(path).release(conn)
+
+# Parsed recipes per user, keyed by (user, recipe version). Every recipe write
+# bumps the user's row in recipe_versions, so each worker process stops using
+# its stale entries as soon as the write commits and they simply age out.
+recipe_cache = LRUCache(app.config['RECIPE_CACHE_SIZE'])
+matrix_cache = LRUCache(app.config['RECIPE_CACHE_SIZE'])
+
+# Logged-in users by id, so @login_required does not hit the database on every
+# request. Users are only ever created, never edited; if that changes, the edit
+# must invalidate the user's entry. The short TTL bounds staleness across workers.
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+# Report data keyed by (kind, business, user, period, data version). Every write
+# that changes what a report shows bumps the business's row in report_versions,
+# so stale entries are never looked up again and simply age out.
+report_cache = LRUCache(app.config['REPORT_CACHE_SIZE'])
+
+# Work that can trail a write (rollups, snapshots, report rendering) runs here
+job_queue = JobQueue(app, get_db, workers=app.config['JOB_WORKERS'], max_pending=app.config['JOB_MAX_PENDING'],
+                     max_attempts=app.config['JOB_MAX_ATTEMPTS'], scopes=tenant_scopes, use_scope=use_business)
 
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+@login_manager.unauthorized_handler
+def unauthorized():
+    # API clients get a 401 instead of being redirected to the login form
+    if request.path.startswith('/api/'):
+        return jsonify(error='Login required.'), 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, request.url))
+
 class User(UserMixin):
     def __init__(self, id, username, role, business_id):
         self.id = id
@@ -26,185 +189,460 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
+    user = user_cache.get(str(user_id))
+    if user is not None:
+        return user
+    conn = get_directory_db()
     c = conn.cursor()
     c.execute("SELECT id, username, role, business_id FROM users WHERE id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return User(user[0], user[1], user[2], user[3]) if user else None
+    row = c.fetchone()
+    if row is None:
+        return None
+    user = User(row[0], row[1], row[2], row[3])
+    user_cache.set(str(user_id), user)
+    return user
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Businesses table
+# Secondary indexes for the per-period and per-report access paths, created by
+# the 'secondary indexes' migration; later indexes need a migration step of their own
+SCHEMA_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_sales_user_year_date ON sales (user_id, year, date, item, quantity)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_period ON inventory_transactions (business_id, year, month, week)",
+    "CREATE INDEX IF NOT EXISTS idx_snapshots_week ON inventory_snapshots (business_id, year, period_type, week, snapshot_type, ingredient, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_snapshots_month ON inventory_snapshots (business_id, year, period_type, month, snapshot_type, ingredient, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at)",
+    JOBS_INDEX,
+]
+
+# Queries on the request path, checked with EXPLAIN QUERY PLAN at startup
+HOT_QUERIES = [
+    ("load_user", "SELECT id, username, role, business_id FROM users WHERE id = ?", (1,)),
+    ("get_recipes", "SELECT r.name, i.name, ri.amount FROM recipes r LEFT JOIN recipe_ingredients ri ON ri.recipe_id = r.id "
+                    "LEFT JOIN ingredients i ON i.id = ri.ingredient_id WHERE r.user_id = ? ORDER BY r.id", (1,)),
+    ("get_inventory week", "SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", (1, 2025, 1, 1)),
+    ("get_inventory month", "SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = "
+                            "(SELECT MAX(week) FROM inventory WHERE business_id = ? AND year = ? AND month = ?)", (1, 2025, 1, 1, 2025, 1)),
+    ("get_inventory year", "SELECT ingredient, amount FROM inventory WHERE business_id = ? AND (year, month, week) = "
+                           "(SELECT year, month, week FROM inventory WHERE business_id = ? AND year = ? ORDER BY week DESC LIMIT 1)", (1, 1, 2025)),
+    ("snapshots week", "SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND week = ? AND snapshot_type = ?", (1, 2025, 'week', 1, 'opening')),
+    ("snapshots month", "SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND month = ? AND snapshot_type = ?", (1, 2025, 'month', 1, 'opening')),
+    ("transactions week", "SELECT ingredient, amount_added, timestamp, user_id FROM inventory_transactions WHERE business_id = ? AND year = ? AND month = ? AND week = ?", (1, 2025, 1, 1)),
+    ("transactions year", "SELECT ingredient, amount_added, timestamp, user_id FROM inventory_transactions WHERE business_id = ? AND year = ?", (1, 2025)),
+    ("get_years", "SELECT DISTINCT year FROM inventory WHERE business_id = ?", (1,)),
+    ("period index", "SELECT DISTINCT year, month, week FROM inventory WHERE business_id = ?", (1,)),
+    ("reorder threshold", "SELECT threshold FROM reorder_thresholds WHERE user_id = ? AND ingredient = ?", (1, 'flour')),
+    ("weekly sales report", "SELECT item, quantity FROM sales_weekly WHERE user_id = ? AND year = ? AND week_start = ? ORDER BY item", (1, 2025, '2025-01-06')),
+    ("monthly sales report", "SELECT item, quantity FROM sales_monthly WHERE user_id = ? AND year = ? AND month = ? ORDER BY item", (1, 2025, '2025-01')),
+    ("yearly sales report", "SELECT item, SUM(quantity) FROM sales_monthly WHERE user_id = ? AND year = ? GROUP BY item", (1, 2025)),
+    ("daily report sales", "SELECT item, quantity FROM sales_daily WHERE user_id = ? AND year = ? AND date = ?", (1, 2025, '2025-01-06')),
+    ("report version", "SELECT version FROM report_versions WHERE business_id = ?", (1,)),
+    ("recipe version", "SELECT version FROM recipe_versions WHERE user_id = ?", (1,)),
+    ("forecast", "SELECT ingredient, week_start, demand, on_hand, reorder, generated_at FROM forecasts WHERE business_id = ? ORDER BY reorder DESC, ingredient", (1,)),
+]
+
+def audit_query_plans(conn=None):
+    # Returns the hot queries that fall back to a full table scan
+    c = (conn or get_db()).cursor()
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        c.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        for row in c.fetchall():
+            detail = row[-1]
+            if detail.startswith('SCAN ') and 'USING' not in detail and 'CONSTANT ROW' not in detail:
+                problems.append((name, detail))
+    for name, detail in problems:
+        logger.warning("Query '%s' falls back to a table scan: %s", name, detail)
+    return problems
+
+SNAPSHOTS_TABLE = '''CREATE TABLE IF NOT EXISTS {table} 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, business_id INTEGER, year INTEGER, 
+                  month INTEGER, week INTEGER, period_type TEXT, snapshot_type TEXT, period_start TEXT, period_end TEXT, 
+                  ingredient TEXT, amount INTEGER,
+                  FOREIGN KEY(business_id) REFERENCES businesses(id),
+                  UNIQUE(business_id, year, period_type, month, week, snapshot_type, ingredient))'''
+
+RECIPES_TABLE = '''CREATE TABLE IF NOT EXISTS {table} 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, name TEXT, 
+                  FOREIGN KEY(user_id) REFERENCES users(id),
+                  UNIQUE(user_id, name))'''
+
+def migrate_recipe_ingredients(c):
+    # Older databases kept one column per ingredient on recipes. Move the
+    # non-zero amounts into recipe_ingredients and drop the wide columns.
+    c.execute("SELECT name FROM pragma_table_info('recipes')")
+    wide = [row[0] for row in c.fetchall() if row[0] not in ('id', 'user_id', 'name')]
+    if not wide:
+        return
+    c.executemany("INSERT OR IGNORE INTO ingredients (name) VALUES (?)", [(column,) for column in wide])
+    for column in wide:
+        c.execute(f"INSERT INTO recipe_ingredients (recipe_id, ingredient_id, amount) "
+                  f"SELECT r.id, i.id, r.{column} FROM recipes r JOIN ingredients i ON i.name = ? WHERE r.{column} > 0", (column,))
+    c.execute(RECIPES_TABLE.format(table='recipes_normalized'))
+    c.execute("INSERT INTO recipes_normalized (id, user_id, name) SELECT id, user_id, name FROM recipes")
+    c.execute("DROP TABLE recipes")
+    c.execute("ALTER TABLE recipes_normalized RENAME TO recipes")
+    c.execute("SELECT COUNT(*) FROM recipe_ingredients")
+    rows = c.fetchone()[0]
+    logger.info("Moved %s recipe ingredient columns into %s recipe_ingredients rows", len(wide), rows)
+
+def migrate_inventory_snapshots(c):
+    # Older databases appended a full set of snapshot rows on every sale. Keep the
+    # first row of each period/ingredient as its opening balance and the last as
+    # its closing balance, then swap in the keyed table.
+    c.execute("SELECT name FROM pragma_table_info('inventory_snapshots')")
+    if 'snapshot_type' in [row[0] for row in c.fetchall()]:
+        return
+    c.execute("SELECT COUNT(*) FROM inventory_snapshots")
+    old_rows = c.fetchone()[0]
+    columns = "business_id, year, month, week, period_type, period_start, period_end, ingredient, amount"
+    group = "business_id, year, month, week, period_type, ingredient"
+    c.execute(SNAPSHOTS_TABLE.format(table='inventory_snapshots_keyed'))
+    c.execute(f"INSERT INTO inventory_snapshots_keyed (snapshot_type, {columns}) SELECT 'opening', {columns} FROM inventory_snapshots "
+              f"WHERE id IN (SELECT MIN(id) FROM inventory_snapshots GROUP BY {group})")
+    c.execute(f"INSERT INTO inventory_snapshots_keyed (snapshot_type, {columns}) SELECT 'closing', {columns} FROM inventory_snapshots "
+              f"WHERE id IN (SELECT MAX(id) FROM inventory_snapshots GROUP BY {group} HAVING COUNT(*) > 1)")
+    c.execute("DROP TABLE inventory_snapshots")
+    c.execute("ALTER TABLE inventory_snapshots_keyed RENAME TO inventory_snapshots")
+    c.execute("SELECT COUNT(*) FROM inventory_snapshots")
+    new_rows = c.fetchone()[0]
+    logger.info("Compacted inventory_snapshots from %s to %s rows", old_rows, new_rows)
+
+# Schema migrations, applied by migrations.migrate() the first time each
+# process opens a database (DB_NAME and, when sharded, every shard). All files
+# share one schema; businesses and users stay empty in shards. Steps must be
+# idempotent: databases from before schema_version existed replay them all.
+
+def create_base_tables(c):
     c.execute('''CREATE TABLE IF NOT EXISTS businesses 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)''')
-    # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, password TEXT, role TEXT, 
                   business_id INTEGER, 
                   FOREIGN KEY(business_id) REFERENCES businesses(id),
                   UNIQUE(business_id, username))''')
-    # Recipes table
-    c.execute('''CREATE TABLE IF NOT EXISTS recipes 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, name TEXT, 
-                  flour INTEGER, water INTEGER, yeast INTEGER, salt INTEGER, sugar INTEGER, 
-                  eggs INTEGER, butter INTEGER, chocolate INTEGER,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  UNIQUE(user_id, name))''')
+    # Ingredient dictionary, recipes and their sparse ingredient amounts
+    c.execute('''CREATE TABLE IF NOT EXISTS ingredients 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)''')
+    c.execute(RECIPES_TABLE.format(table='recipes'))
+    c.execute('''CREATE TABLE IF NOT EXISTS recipe_ingredients 
+                 (recipe_id INTEGER, ingredient_id INTEGER, amount INTEGER,
+                  FOREIGN KEY(recipe_id) REFERENCES recipes(id),
+                  FOREIGN KEY(ingredient_id) REFERENCES ingredients(id),
+                  PRIMARY KEY(recipe_id, ingredient_id))''')
     # Inventory table (includes week and month)
     c.execute('''CREATE TABLE IF NOT EXISTS inventory 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, business_id INTEGER, year INTEGER, 
                   month INTEGER, week INTEGER, ingredient TEXT, amount INTEGER,
                   FOREIGN KEY(business_id) REFERENCES businesses(id),
                   UNIQUE(business_id, year, month, week, ingredient))''')
-    # Inventory snapshots for opening/closing
-    c.execute('''CREATE TABLE IF NOT EXISTS inventory_snapshots 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, business_id INTEGER, year INTEGER, 
-                  month INTEGER, week INTEGER, period_type TEXT, period_start TEXT, period_end TEXT, 
-                  ingredient TEXT, amount INTEGER,
-                  FOREIGN KEY(business_id) REFERENCES businesses(id))''')
-    # Inventory transactions
+    # Inventory snapshots: one opening and one closing balance per period and ingredient
+    c.execute(SNAPSHOTS_TABLE.format(table='inventory_snapshots'))
     c.execute('''CREATE TABLE IF NOT EXISTS inventory_transactions 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, business_id INTEGER, year INTEGER, 
                   month INTEGER, week INTEGER, ingredient TEXT, amount_added INTEGER, 
                   timestamp TEXT, user_id INTEGER,
                   FOREIGN KEY(business_id) REFERENCES businesses(id),
                   FOREIGN KEY(user_id) REFERENCES users(id))''')
-    # Sales table
     c.execute('''CREATE TABLE IF NOT EXISTS sales 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, year INTEGER, 
                   item TEXT, quantity INTEGER, date TEXT,
                   FOREIGN KEY(user_id) REFERENCES users(id))''')
-    # Initial inventory table
     c.execute('''CREATE TABLE IF NOT EXISTS initial_inventory 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, ingredient TEXT UNIQUE, amount INTEGER)''')
-    
-    c.execute("INSERT OR IGNORE INTO businesses (name) VALUES (?)", ("Default Bakery",))
-    c.execute("SELECT id FROM businesses WHERE name = ?", ("Default Bakery",))
-    business_id = c.fetchone()[0]
-    c.execute("INSERT OR IGNORE INTO users (username, password, role, business_id) VALUES (?, ?, ?, ?)", 
-              ("admin", generate_password_hash("adminpass"), "admin", business_id))
-    
     initial_inventory_data = [
         ('flour', 10000), ('water', 5000), ('yeast', 200), ('salt', 200), 
         ('sugar', 2000), ('eggs', 50), ('butter', 3000), ('chocolate', 1000)
     ]
     c.executemany("INSERT OR IGNORE INTO initial_inventory (ingredient, amount) VALUES (?, ?)", initial_inventory_data)
-    
-    conn.commit()
-    conn.close()
-    print("Database initialized with Default Bakery, admin user, and initial inventory.")
+    c.execute("INSERT OR IGNORE INTO ingredients (name) SELECT ingredient FROM initial_inventory ORDER BY id")
 
-# Helper functions for week date calculations
-def get_week_start_date(year, week):
-    jan4 = datetime(year, 1, 4)
-    first_monday = jan4 - timedelta(days=jan4.weekday())
-    week_start = first_monday + timedelta(weeks=week - 1)
-    return week_start.strftime('%Y-%m-%d')
+def create_sales_rollups(c):
+    # Sales rollups maintained on every sale write, read by the sales reports
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_daily 
+                 (user_id INTEGER, year INTEGER, date TEXT, item TEXT, quantity INTEGER,
+                  PRIMARY KEY(user_id, year, date, item))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_weekly 
+                 (user_id INTEGER, year INTEGER, week_start TEXT, item TEXT, quantity INTEGER,
+                  PRIMARY KEY(user_id, year, week_start, item))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_monthly 
+                 (user_id INTEGER, year INTEGER, month TEXT, item TEXT, quantity INTEGER,
+                  PRIMARY KEY(user_id, year, month, item))''')
+    c.execute("SELECT EXISTS (SELECT 1 FROM sales) AND NOT EXISTS (SELECT 1 FROM sales_monthly)")
+    if c.fetchone()[0]:
+        fill_sales_rollups(c)
 
-def get_week_end_date(year, week):
-    start_date = datetime.strptime(get_week_start_date(year, week), '%Y-%m-%d')
-    end_date = start_date + timedelta(days=6)
-    return end_date.strftime('%Y-%m-%d')
+def create_reorder_thresholds(c):
+    # The most any single recipe of the user needs of an ingredient
+    c.execute('''CREATE TABLE IF NOT EXISTS reorder_thresholds 
+                 (user_id INTEGER, ingredient TEXT, threshold INTEGER,
+                  FOREIGN KEY(user_id) REFERENCES users(id),
+                  PRIMARY KEY(user_id, ingredient))''')
+    fill_reorder_thresholds(c)
+
+def create_idempotency_keys(c):
+    # Stored /api/sales responses, replayed when a till retries with the same key
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys 
+                 (user_id INTEGER, key TEXT, request_hash TEXT, status INTEGER, response TEXT, created_at TEXT,
+                  FOREIGN KEY(user_id) REFERENCES users(id),
+                  PRIMARY KEY(user_id, key))''')
+
+def create_forecasts(c):
+    # Next week's ingredient demand and reorder list per business, rebuilt nightly
+    c.execute('''CREATE TABLE IF NOT EXISTS forecasts 
+                 (business_id INTEGER, ingredient TEXT, week_start TEXT, demand INTEGER, on_hand INTEGER, 
+                  reorder INTEGER, generated_at TEXT,
+                  FOREIGN KEY(business_id) REFERENCES businesses(id),
+                  PRIMARY KEY(business_id, ingredient))''')
+
+def create_report_versions(c):
+    # Report data version per business, bumped by every sale and stock change
+    c.execute('''CREATE TABLE IF NOT EXISTS report_versions 
+                 (business_id INTEGER PRIMARY KEY, version INTEGER,
+                  FOREIGN KEY(business_id) REFERENCES businesses(id))''')
+
+def create_jobs(c):
+    # Background jobs queued by writes, see jobs.py
+    c.execute(JOBS_TABLE)
+
+def create_indexes(c):
+    for statement in SCHEMA_INDEXES:
+        c.execute(statement)
+
+def create_recipe_versions(c):
+    # Recipe data version per user, bumped by every recipe write
+    c.execute('''CREATE TABLE IF NOT EXISTS recipe_versions 
+                 (user_id INTEGER PRIMARY KEY, version INTEGER,
+                  FOREIGN KEY(user_id) REFERENCES users(id))''')
+
+def fold_split_month_weeks(c):
+    # Before periods.py, a week's month was the calendar month of the day it
+    # was written, so a week spanning two months could be stored under both.
+    # Fold each such week onto week_month(): its inventory keeps the month
+    # written last, its snapshots keep the first opening and last closing
+    # balance per ingredient, and its transactions are moved across.
+    c.execute("SELECT business_id, year, week, GROUP_CONCAT(DISTINCT month) FROM inventory GROUP BY business_id, year, week "
+              "UNION SELECT business_id, year, week, GROUP_CONCAT(DISTINCT month) FROM inventory_snapshots WHERE period_type = 'week' "
+              "GROUP BY business_id, year, week")
+    folded = set()
+    for business_id, year, week, months in c.fetchall():
+        month = week_month(year, week)
+        if (business_id, year, week) in folded or {int(m) for m in months.split(',')} == {month}:
+            continue
+        folded.add((business_id, year, week))
+        key = (business_id, year, week)
+        c.execute("DELETE FROM inventory WHERE business_id = ? AND year = ? AND week = ? AND month != "
+                  "(SELECT month FROM inventory WHERE business_id = ? AND year = ? AND week = ? ORDER BY id DESC LIMIT 1)", key + key)
+        c.execute("UPDATE inventory SET month = ? WHERE business_id = ? AND year = ? AND week = ?", (month, *key))
+        c.execute("UPDATE inventory_transactions SET month = ? WHERE business_id = ? AND year = ? AND week = ?", (month, *key))
+        c.execute("DELETE FROM inventory_snapshots WHERE business_id = ? AND year = ? AND week = ? AND period_type = 'week' AND id NOT IN "
+                  "(SELECT CASE snapshot_type WHEN 'opening' THEN MIN(id) ELSE MAX(id) END FROM inventory_snapshots "
+                  "WHERE business_id = ? AND year = ? AND week = ? AND period_type = 'week' GROUP BY snapshot_type, ingredient)", key + key)
+        c.execute("UPDATE inventory_snapshots SET month = ? WHERE business_id = ? AND year = ? AND week = ? AND period_type = 'week'", (month, *key))
+    if folded:
+        logger.info("Folded %s split-month weeks onto one month each", len(folded))
+
+MIGRATIONS = [
+    ('base tables', create_base_tables),
+    ('sparse recipe ingredients', migrate_recipe_ingredients),
+    ('keyed inventory snapshots', migrate_inventory_snapshots),
+    ('sales rollups', create_sales_rollups),
+    ('reorder thresholds', create_reorder_thresholds),
+    ('idempotency keys', create_idempotency_keys),
+    ('forecasts', create_forecasts),
+    ('report versions', create_report_versions),
+    ('jobs', create_jobs),
+    ('secondary indexes', create_indexes),
+    ('recipe versions', create_recipe_versions),
+    ('fold split-month weeks', fold_split_month_weeks),
+]
+
+def ensure_schema(conn, path):
+    # Once per process per database file: a version check, and the pending
+    # migrations when the file is behind
+    started_at = migrate(conn, MIGRATIONS)
+    if started_at < len(MIGRATIONS):
+        logger.info("Migrated %s from schema version %s to %s", path, started_at, len(MIGRATIONS))
+    if started_at == 0 and path == app.config['DB_NAME']:
+        # New directory: seed the default business and its admin
+        c = conn.cursor()
+        with transaction(conn):
+            c.execute("INSERT OR IGNORE INTO businesses (name) VALUES (?)", ("Default Bakery",))
+            c.execute("SELECT id FROM businesses WHERE name = ?", ("Default Bakery",))
+            business_id = c.fetchone()[0]
+            c.execute("INSERT OR IGNORE INTO users (username, password, role, business_id) VALUES (?, ?, ?, ?)", 
+                      ("admin", generate_password_hash("adminpass"), "admin", business_id))
+
+def init_db():
+    # Databases migrate themselves on first use; this opens them all up front
+    get_directory_db()
+    for scope in tenant_scopes():
+        with use_business(scope):
+            get_db()
+    logger.info("Databases are at schema version %s", len(MIGRATIONS))
 
 def get_current_period():
-    now = datetime.now()
-    year = now.year
-    month = now.month
-    week = now.isocalendar()[1]
-    return year, month, week
+    # ISO year and week, with the month the week belongs to (see periods.py)
+    return current_period()
 
-def populate_user_data(user_id, business_id, year=datetime.now().year, month=datetime.now().month, week=datetime.now().isocalendar()[1]):
-    conn = sqlite3.connect(DB_NAME)
+def populate_user_data(user_id, business_id, year=None, month=None, week=None):
+    if year is None or month is None or week is None:
+        year, month, week = get_current_period()
+    conn = get_db()
     c = conn.cursor()
     # Populate recipes if none exist for the user
     c.execute("SELECT COUNT(*) FROM recipes WHERE user_id = ?", (user_id,))
-    if c.fetchone()[0] == 0:
-        initial_recipes = [
-            (user_id, 'Bread', 500, 300, 10, 10, 0, 0, 0, 0),
-            (user_id, 'Cake', 300, 0, 0, 0, 200, 3, 150, 0),
-            (user_id, 'Cookies', 200, 0, 0, 0, 100, 0, 100, 50)
-        ]
-        c.executemany("INSERT INTO recipes (user_id, name, flour, water, yeast, salt, sugar, eggs, butter, chocolate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", initial_recipes)
-        print(f"Populated recipes for user_id {user_id}")
-    
-    # Populate inventory if none exist for the business, year, month, and week
+    seeded_recipes = c.fetchone()[0] == 0
+    if seeded_recipes:
+        initial_recipes = {
+            'Bread': {'flour': 500, 'water': 300, 'yeast': 10, 'salt': 10},
+            'Cake': {'flour': 300, 'sugar': 200, 'eggs': 3, 'butter': 150},
+            'Cookies': {'flour': 200, 'sugar': 100, 'butter': 100, 'chocolate': 50},
+        }
+        for name, amounts in initial_recipes.items():
+            c.execute("INSERT INTO recipes (user_id, name) VALUES (?, ?)", (user_id, name))
+            save_recipe_ingredients(c, c.lastrowid, amounts)
+        bump_recipe_version(c, user_id)
+        refresh_reorder_thresholds(user_id)
+        logger.info("Populated recipes for user_id %s", user_id)
+    seed_week(c, business_id, year, month, week)
+    conn.commit()
+
+def seed_week(c, business_id, year, month, week):
+    # Populate inventory if none exist for the business, year, month, and week:
+    # carry forward the latest earlier week's balances, or start from
+    # initial_inventory when the business has no earlier week. Does not commit,
+    # so writers can seed the weeks they touch inside their own transaction.
     c.execute("SELECT COUNT(*) FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", 
               (business_id, year, month, week))
     if c.fetchone()[0] == 0:
-        c.execute("SELECT ingredient, amount FROM initial_inventory")
-        initial_inventory = c.fetchall()
-        inventory_data = [(business_id, year, month, week, ingredient, amount) for ingredient, amount in initial_inventory]
-        c.executemany("INSERT INTO inventory (business_id, year, month, week, ingredient, amount) VALUES (?, ?, ?, ?, ?, ?)", inventory_data)
-        # Take opening snapshot
-        snapshot_data = [(business_id, year, month, week, 'week', 
-                          get_week_start_date(year, week),
-                          get_week_end_date(year, week),
-                          ingredient, amount) for ingredient, amount in initial_inventory]
-        c.executemany("INSERT INTO inventory_snapshots (business_id, year, month, week, period_type, period_start, period_end, ingredient, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", snapshot_data)
-        print(f"Populated inventory for business_id {business_id}, year {year}, month {month}, week {week} from initial_inventory table")
-    
-    conn.commit()
-    conn.close()
+        c.execute("INSERT INTO inventory (business_id, year, month, week, ingredient, amount) "
+                  "SELECT business_id, ?, ?, ?, ingredient, amount FROM inventory WHERE business_id = ? AND (year, month, week) = "
+                  "(SELECT year, month, week FROM inventory WHERE business_id = ? AND (year < ? OR (year = ? AND week < ?)) "
+                  "ORDER BY year DESC, week DESC, month DESC LIMIT 1)", 
+                  (year, month, week, business_id, business_id, year, year, week))
+        source = 'the previous week'
+        if c.rowcount == 0:
+            c.execute("INSERT INTO inventory (business_id, year, month, week, ingredient, amount) "
+                      "SELECT ?, ?, ?, ?, ingredient, amount FROM initial_inventory", (business_id, year, month, week))
+            source = 'initial_inventory'
+        take_snapshot(c, 'opening', business_id, year, month, week)
+        logger.info("Populated inventory for business_id %s, year %s, month %s, week %s from %s", business_id, year, month, week, source)
 
 # Helper functions
 def get_businesses():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_directory_db()
     c = conn.cursor()
     c.execute("SELECT id, name FROM businesses")
     businesses = dict(c.fetchall())
-    conn.close()
     return businesses
 
 def get_users(business_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_directory_db()
     c = conn.cursor()
     c.execute("SELECT id, username, role FROM users WHERE business_id = ? AND id != ?", (business_id, current_user.id))
     users = c.fetchall()
-    conn.close()
     return users
 
-def get_recipes(user_id):
-    conn = sqlite3.connect(DB_NAME)
+def get_recipe_version(user_id):
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT name, flour, water, yeast, salt, sugar, eggs, butter, chocolate FROM recipes WHERE user_id = ?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return {row[0]: dict(zip(['flour', 'water', 'yeast', 'salt', 'sugar', 'eggs', 'butter', 'chocolate'], row[1:])) for row in rows}
+    c.execute("SELECT version FROM recipe_versions WHERE user_id = ?", (user_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def bump_recipe_version(c, user_id):
+    # Called inside the recipe write's transaction so caches change with the data
+    c.execute("INSERT INTO recipe_versions (user_id, version) VALUES (?, 1) "
+              "ON CONFLICT(user_id) DO UPDATE SET version = version + 1", (user_id,))
+
+def get_recipes(user_id, version=None):
+    # {recipe: {ingredient: amount}} holding only the ingredients each recipe
+    # uses. The returned dict is shared through the cache and must not be mutated.
+    if version is None:
+        version = get_recipe_version(user_id)
+    recipes = recipe_cache.get((user_id, version))
+    if recipes is not None:
+        return recipes
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT r.name, i.name, ri.amount FROM recipes r LEFT JOIN recipe_ingredients ri ON ri.recipe_id = r.id "
+              "LEFT JOIN ingredients i ON i.id = ri.ingredient_id WHERE r.user_id = ? ORDER BY r.id", (user_id,))
+    recipes = {}
+    for name, ingredient, amount in c.fetchall():
+        amounts = recipes.setdefault(name, {})
+        if ingredient is not None:
+            amounts[ingredient] = amount
+    recipe_cache.set((user_id, version), recipes)
+    return recipes
+
+def get_ingredient_names():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT name FROM ingredients ORDER BY id")
+    return [row[0] for row in c.fetchall()]
+
+def save_recipe_ingredients(c, recipe_id, amounts):
+    # Replaces the recipe's ingredient rows with its non-zero amounts; names
+    # missing from the ingredient dictionary are added to it
+    amounts = {name: amount for name, amount in amounts.items() if amount}
+    c.executemany("INSERT OR IGNORE INTO ingredients (name) VALUES (?)", [(name,) for name in amounts])
+    c.execute("DELETE FROM recipe_ingredients WHERE recipe_id = ?", (recipe_id,))
+    c.executemany("INSERT INTO recipe_ingredients (recipe_id, ingredient_id, amount) SELECT ?, id, ? FROM ingredients WHERE name = ?", 
+                  [(recipe_id, amount, name) for name, amount in amounts.items()])
+
+def recipe_form_amounts(form):
+    # Amounts for every dictionary ingredient plus an optional new one
+    amounts = {name: int(form.get(name) or 0) for name in get_ingredient_names()}
+    new_ingredient = form.get('new_ingredient', '').strip().lower()
+    if new_ingredient:
+        amounts[new_ingredient] = int(form.get('new_amount') or 0)
+    return amounts
+
+def fill_reorder_thresholds(c, user_id=None):
+    delete_where, select_where, params = ("WHERE user_id = ?", "WHERE r.user_id = ?", (user_id,)) if user_id is not None else ("", "", ())
+    c.execute(f"DELETE FROM reorder_thresholds {delete_where}", params)
+    c.execute(f"INSERT INTO reorder_thresholds (user_id, ingredient, threshold) "
+              f"SELECT r.user_id, i.name, MAX(ri.amount) FROM recipes r JOIN recipe_ingredients ri ON ri.recipe_id = r.id "
+              f"JOIN ingredients i ON i.id = ri.ingredient_id {select_where} GROUP BY r.user_id, i.name", params)
+
+def refresh_reorder_thresholds(user_id=None):
+    # Rebuilt on every recipe write so sales never have to scan recipes
+    conn = get_db()
+    with transaction(conn):
+        fill_reorder_thresholds(conn.cursor(), user_id)
 
 def get_inventory(business_id, year, month=None, week=None):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     if month is not None and week is not None:
         c.execute("SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", 
                   (business_id, year, month, week))
     elif month is not None:
-        c.execute("SELECT ingredient, SUM(amount) FROM inventory WHERE business_id = ? AND year = ? AND month = ? GROUP BY ingredient", 
-                  (business_id, year, month))
+        # Stock is a level, not a flow: a month holds what its latest week holds
+        c.execute("SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = "
+                  "(SELECT MAX(week) FROM inventory WHERE business_id = ? AND year = ? AND month = ?)", 
+                  (business_id, year, month, business_id, year, month))
     else:
-        c.execute("SELECT ingredient, SUM(amount) FROM inventory WHERE business_id = ? AND year = ? GROUP BY ingredient", 
-                  (business_id, year))
+        c.execute("SELECT ingredient, amount FROM inventory WHERE business_id = ? AND (year, month, week) = "
+                  "(SELECT year, month, week FROM inventory WHERE business_id = ? AND year = ? ORDER BY week DESC LIMIT 1)", 
+                  (business_id, business_id, year))
     rows = c.fetchall()
-    conn.close()
-    print(f"Fetched inventory for business_id {business_id}, year {year}, month {month}, week {week}: {dict(rows)}")
+    logger.debug("Fetched inventory for business_id %s, year %s, month %s, week %s: %s", business_id, year, month, week, rows)
     return dict(rows)
 
-def get_opening_closing_inventory(business_id, year, period_type, period_value):
-    conn = sqlite3.connect(DB_NAME)
+def get_opening_closing_inventory(business_id, year, period_type, period_value, snapshot_type='opening'):
+    conn = get_db()
     c = conn.cursor()
     if period_type == 'week':
-        c.execute("SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND week = ?", 
-                  (business_id, year, 'week', period_value))
+        c.execute("SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND week = ? AND snapshot_type = ?", 
+                  (business_id, year, 'week', period_value, snapshot_type))
     elif period_type == 'month':
-        c.execute("SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND month = ?", 
-                  (business_id, year, 'month', period_value))
+        c.execute("SELECT ingredient, amount FROM inventory_snapshots WHERE business_id = ? AND year = ? AND period_type = ? AND month = ? AND snapshot_type = ?", 
+                  (business_id, year, 'month', period_value, snapshot_type))
     rows = c.fetchall()
-    conn.close()
     return dict(rows)
 
 def get_inventory_transactions(business_id, year, month=None, week=None):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     if month is not None and week is not None:
         c.execute("SELECT ingredient, amount_added, timestamp, user_id FROM inventory_transactions WHERE business_id = ? AND year = ? AND month = ? AND week = ?", 
@@ -216,42 +654,128 @@ def get_inventory_transactions(business_id, year, month=None, week=None):
         c.execute("SELECT ingredient, amount_added, timestamp, user_id FROM inventory_transactions WHERE business_id = ? AND year = ?", 
                   (business_id, year))
     rows = c.fetchall()
-    conn.close()
     return rows
 
 def get_years(business_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT DISTINCT year FROM inventory WHERE business_id = ?", (business_id,))
     years = [row[0] for row in c.fetchall()]
-    conn.close()
     return years
 
-def get_months(business_id, year):
-    conn = sqlite3.connect(DB_NAME)
+def load_dashboard(user_id, business_id, year, month, week):
+    # Everything home() shows in six queries: periods, business name, balances,
+    # transactions, recipe version and forecast, plus the recipes themselves
+    # on a recipe cache miss. Returns the template data and a (step, seconds)
+    # timing breakdown.
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT DISTINCT month FROM inventory WHERE business_id = ? AND year = ?", (business_id, year))
-    months = [row[0] for row in c.fetchall()]
-    conn.close()
-    return sorted(months)
+    timings = []
+    started = time.perf_counter()
+    def lap(name):
+        nonlocal started
+        now = time.perf_counter()
+        timings.append((name, now - started))
+        started = now
+
+    c.execute("SELECT DISTINCT year, month, week FROM inventory WHERE business_id = ?", (business_id,))
+    periods = c.fetchall()
+    if year not in {row[0] for row in periods}:
+        populate_user_data(user_id, business_id, year, month, week)
+        c.execute("SELECT DISTINCT year, month, week FROM inventory WHERE business_id = ?", (business_id,))
+        periods = c.fetchall()
+    lap('periods')
+    directory = get_directory_db().cursor()
+    directory.execute("SELECT name FROM businesses WHERE id = ?", (business_id,))
+    business_name = directory.fetchone()[0]
+    lap('business')
+    c.execute("SELECT 'current', ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ? "
+              "UNION ALL SELECT 'opening', ingredient, amount FROM inventory_snapshots "
+              "WHERE business_id = ? AND year = ? AND period_type = 'week' AND week = ? AND snapshot_type = 'opening' ORDER BY 1, 2", 
+              (business_id, year, month, week, business_id, year, week))
+    balances = {'current': {}, 'opening': {}}
+    for kind, ingredient, amount in c.fetchall():
+        balances[kind][ingredient] = amount
+    lap('inventory')
+    transactions = get_inventory_transactions(business_id, year, month, week)
+    lap('transactions')
+    recipes = get_recipes(user_id)
+    lap('recipes')
+    forecast = get_forecast(business_id)
+    lap('forecast')
+    return {
+        'years': sorted({y for y, m, w in periods}),
+        'months': sorted({m for y, m, w in periods if y == year}),
+        'weeks': sorted({w for y, m, w in periods if y == year and m == month}),
+        'business_name': business_name,
+        'inventory': balances['current'],
+        'opening_inventory': balances['opening'],
+        'transactions': transactions,
+        'recipes': recipes,
+        'forecast': forecast,
+    }, timings
 
-def get_weeks(business_id, year, month):
-    conn = sqlite3.connect(DB_NAME)
+def build_forecast(business_id, window=None, safety=None):
+    # Forecasts next week's sales for every user of the business from one read
+    # of the daily rollup, turns them into ingredient demand through each
+    # user's recipe matrix and stores the reorder list for the dashboard
+    window = window or app.config['FORECAST_WINDOW']
+    safety = app.config['FORECAST_SAFETY'] if safety is None else safety
+    year, month, week = get_current_period()
+    next_week = week_start(year, week) + timedelta(weeks=1)
+    since = next_week - timedelta(days=history_days(window))
+    directory = get_directory_db().cursor()
+    directory.execute("SELECT id FROM users WHERE business_id = ?", (business_id,))
+    user_ids = [row[0] for row in directory.fetchall()]
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT DISTINCT week FROM inventory WHERE business_id = ? AND year = ? AND month = ?", (business_id, year, month))
-    weeks = [row[0] for row in c.fetchall()]
-    conn.close()
-    return sorted(weeks)
+    c.execute(f"SELECT user_id, item, date, quantity FROM sales_daily WHERE user_id IN ({', '.join('?' * len(user_ids))}) "
+              "AND year >= ? AND date >= ? AND date < ?", (*user_ids, since.year - 1, since.isoformat(), next_week.isoformat()))
+    item_forecasts = forecast_items((((user_id, item), day, quantity) for user_id, item, day, quantity in c.fetchall()), next_week, window)
+    per_user = {}
+    for (user_id, item), quantity in item_forecasts.items():
+        per_user.setdefault(user_id, {})[item] = quantity
+    demand = {}
+    for user_id, sales in per_user.items():
+        for ingredient, amount in get_recipe_matrix(user_id).requirements(sales).items():
+            demand[ingredient] = demand.get(ingredient, 0) + amount
+    rows = reorder_list(demand, get_inventory(business_id, year, month, week), safety)
+    generated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with transaction(conn):
+        c.execute("DELETE FROM forecasts WHERE business_id = ?", (business_id,))
+        c.executemany("INSERT INTO forecasts (business_id, ingredient, week_start, demand, on_hand, reorder, generated_at) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                      [(business_id, row['ingredient'], next_week.isoformat(), row['demand'], row['on_hand'], row['reorder'], generated_at) for row in rows])
+    logger.info("Forecast %s ingredients for business_id %s, week of %s", len(rows), business_id, next_week)
+    return rows
+
+def get_forecast(business_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT ingredient, week_start, demand, on_hand, reorder, generated_at FROM forecasts WHERE business_id = ? ORDER BY reorder DESC, ingredient", 
+              (business_id,))
+    columns = ('ingredient', 'week_start', 'demand', 'on_hand', 'reorder', 'generated_at')
+    return [dict(zip(columns, row)) for row in c.fetchall()]
+
+def get_recipe_matrix(user_id):
+    version = get_recipe_version(user_id)
+    matrix = matrix_cache.get((user_id, version))
+    if matrix is None:
+        matrix = RecipeMatrix(get_recipes(user_id, version))
+        matrix_cache.set((user_id, version), matrix)
+    return matrix
 
 def compute_ingredients(daily_sales, user_id):
-    recipes = get_recipes(user_id)
-    total_ingredients = {}
-    for item, quantity_sold in daily_sales.items():
-        if quantity_sold > 0 and item in recipes:
-            for ingredient, amount in recipes[item].items():
-                if amount > 0:
-                    total_ingredients[ingredient] = total_ingredients.get(ingredient, 0) + amount * quantity_sold
-    return total_ingredients
+    return get_recipe_matrix(user_id).requirements(daily_sales)
+
+def plan_production(scenarios, user_id, business_id, year, month, week):
+    # Requirements and shortfalls for many sales scenarios against one inventory read
+    matrix = get_recipe_matrix(user_id)
+    inventory = get_inventory(business_id, year, month, week)
+    results = []
+    for requirements in matrix.batch_requirements(scenarios):
+        shortfalls = matrix.shortfalls(requirements, inventory)
+        results.append({'requirements': requirements, 'shortfalls': shortfalls, 'feasible': not shortfalls})
+    return inventory, results
 
 def check_inventory(total_ingredients, business_id, year, month, week):
     inventory = get_inventory(business_id, year, month, week)
@@ -262,34 +786,91 @@ def check_inventory(total_ingredients, business_id, year, month, week):
             insufficient.append(f"Not enough {ingredient}: need {amount_needed}, have {current_amount}")
     return insufficient
 
-def update_inventory(total_ingredients, business_id, year, month, week):
-    conn = sqlite3.connect(DB_NAME)
+def take_snapshot(c, snapshot_type, business_id, year, month, week):
+    # Upsert the week's opening or closing balances in one statement; returns the balances
+    period_start, period_end = week_bounds(year, week)
+    c.execute("INSERT INTO inventory_snapshots (business_id, year, month, week, period_type, snapshot_type, period_start, period_end, ingredient, amount) "
+              "SELECT business_id, year, month, week, 'week', ?, ?, ?, ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ? "
+              "ON CONFLICT(business_id, year, period_type, month, week, snapshot_type, ingredient) DO UPDATE SET amount = excluded.amount "
+              "RETURNING ingredient, amount", 
+              (snapshot_type, period_start, period_end, business_id, year, month, week))
+    return dict(c.fetchall())
+
+def close_period(business_id, year, week):
+    # Closes an ISO week: records its closing balances and carries them into
+    # the next week as its opening balances, with month snapshots kept
+    # alongside. A fixed number of set-based statements, however many
+    # ingredients there are. Activity already recorded against the next week
+    # is kept and rebased onto the carried balances. Returns the closing balances.
+    month = week_month(year, week)
+    next_year, next_month, next_week = period_for_date(week_start(year, week) + timedelta(weeks=1))
+    next_start, next_end = week_bounds(next_year, next_week)
+    month_start = datetime(year, month, 1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    conn = get_db()
+    c = conn.cursor()
+    with transaction(conn):
+        closing = take_snapshot(c, 'closing', business_id, year, month, week)
+        if not closing:
+            return closing
+        c.execute("INSERT INTO inventory (business_id, year, month, week, ingredient, amount) "
+                  "SELECT business_id, ?, ?, ?, ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND true "
+                  "ON CONFLICT(business_id, year, month, week, ingredient) DO UPDATE SET amount = inventory.amount + excluded.amount - COALESCE("
+                  "(SELECT s.amount FROM inventory_snapshots s WHERE s.business_id = inventory.business_id AND s.year = inventory.year AND s.period_type = 'week' "
+                  "AND s.month = inventory.month AND s.week = inventory.week AND s.snapshot_type = 'opening' AND s.ingredient = inventory.ingredient), inventory.amount)", 
+                  (next_year, next_month, next_week, business_id, year, month, week))
+        c.execute("INSERT INTO inventory_snapshots (business_id, year, month, week, period_type, snapshot_type, period_start, period_end, ingredient, amount) "
+                  "SELECT business_id, ?, ?, ?, 'week', 'opening', ?, ?, ingredient, amount FROM inventory_snapshots "
+                  "WHERE business_id = ? AND year = ? AND period_type = 'week' AND month = ? AND week = ? AND snapshot_type = 'closing' AND true "
+                  "ON CONFLICT(business_id, year, period_type, month, week, snapshot_type, ingredient) DO UPDATE SET amount = excluded.amount", 
+                  (next_year, next_month, next_week, next_start, next_end, business_id, year, month, week))
+        take_snapshot(c, 'closing', business_id, next_year, next_month, next_week)
+        # Month snapshots (week 0): the first closed week's opening, the last closed week's closing
+        for snapshot_type, conflict in (('opening', 'NOTHING'), ('closing', 'UPDATE SET amount = excluded.amount')):
+            c.execute("INSERT INTO inventory_snapshots (business_id, year, month, week, period_type, snapshot_type, period_start, period_end, ingredient, amount) "
+                      "SELECT business_id, year, month, 0, 'month', snapshot_type, ?, ?, ingredient, amount FROM inventory_snapshots "
+                      "WHERE business_id = ? AND year = ? AND period_type = 'week' AND month = ? AND week = ? AND snapshot_type = ? AND true "
+                      f"ON CONFLICT(business_id, year, period_type, month, week, snapshot_type, ingredient) DO {conflict}", 
+                      (month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d'), business_id, year, month, week, snapshot_type))
+        bump_report_version(c, business_id)
+    logger.info("Closed business_id %s, year %s, week %s into year %s, week %s", business_id, year, week, next_year, next_week)
+    return closing
+
+def bump_report_version(c, business_id):
+    # Called inside the write's transaction so cached reports change with the data
+    c.execute("INSERT INTO report_versions (business_id, version) VALUES (?, 1) "
+              "ON CONFLICT(business_id) DO UPDATE SET version = version + 1", (business_id,))
+
+class InsufficientInventory(Exception):
+    pass
+
+def update_inventory(total_ingredients, business_id, year, month, week, user_id):
+    conn = get_db()
     c = conn.cursor()
     low_stock = []
-    for ingredient, amount_used in total_ingredients.items():
-        c.execute("UPDATE inventory SET amount = amount - ? WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ?", 
-                  (amount_used, business_id, year, month, week, ingredient))
-        c.execute("SELECT amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ?", 
-                  (business_id, year, month, week, ingredient))
-        remaining = c.fetchone()[0]
-        if remaining < 0:
-            low_stock.append(f"{ingredient} is depleted! ({remaining} units)")
-        elif remaining < max([r.get(ingredient, 0) for r in get_recipes(current_user.id).values()]):
-            low_stock.append(f"{ingredient} is running low ({remaining} units left)")
-    # Take closing snapshot for the week
-    inventory = get_inventory(business_id, year, month, week)
-    snapshot_data = [(business_id, year, month, week, 'week', 
-                      get_week_start_date(year, week),
-                      get_week_end_date(year, week),
-                      ingredient, amount) for ingredient, amount in inventory.items()]
-    c.executemany("INSERT OR REPLACE INTO inventory_snapshots (business_id, year, month, week, period_type, period_start, period_end, ingredient, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", snapshot_data)
-    conn.commit()
-    conn.close()
-    print(f"Inventory updated for business_id {business_id}, year {year}, month {month}, week {week}")
-    return low_stock
+    with transaction(conn):
+        # Conditional decrement: a row only changes if it still has enough stock.
+        # RETURNING hands back the new balance and the user's reorder threshold,
+        # so the low-stock check needs no further queries.
+        for ingredient, amount_used in total_ingredients.items():
+            c.execute("UPDATE inventory SET amount = amount - ? WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ? AND amount >= ? "
+                      "RETURNING amount, (SELECT threshold FROM reorder_thresholds WHERE user_id = ? AND ingredient = inventory.ingredient)", 
+                      (amount_used, business_id, year, month, week, ingredient, amount_used, user_id))
+            row = c.fetchone()
+            if row is None:
+                raise InsufficientInventory()
+            remaining, threshold = row
+            if threshold is not None and remaining < threshold:
+                low_stock.append(f"{ingredient} is running low ({remaining} units left)")
+        # The closing snapshot is left to the sale's follow-up job
+        c.execute("SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", 
+                  (business_id, year, month, week))
+        inventory = dict(c.fetchall())
+    logger.info("Inventory updated for business_id %s, year %s, month %s, week %s", business_id, year, month, week)
+    return low_stock, inventory
 
 def reset_inventory(business_id, year, month, week):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("DELETE FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", (business_id, year, month, week))
     c.execute("SELECT ingredient, amount FROM initial_inventory")
@@ -300,160 +881,515 @@ def reset_inventory(business_id, year, month, week):
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     transaction_data = [(business_id, year, month, week, ingredient, amount, timestamp, current_user.id) for ingredient, amount in initial_inventory]
     c.executemany("INSERT INTO inventory_transactions (business_id, year, month, week, ingredient, amount_added, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", transaction_data)
-    # Take opening snapshot
-    snapshot_data = [(business_id, year, month, week, 'week', 
-                      get_week_start_date(year, week),
-                      get_week_end_date(year, week),
-                      ingredient, amount) for ingredient, amount in initial_inventory]
-    c.executemany("INSERT OR REPLACE INTO inventory_snapshots (business_id, year, month, week, period_type, period_start, period_end, ingredient, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", snapshot_data)
+    # The reset balances are both the new opening and the current closing balance
+    take_snapshot(c, 'opening', business_id, year, month, week)
+    take_snapshot(c, 'closing', business_id, year, month, week)
+    bump_report_version(c, business_id)
     conn.commit()
-    conn.close()
-    print(f"Inventory reset for business_id {business_id}, year {year}, month {month}, week {week}")
+    logger.info("Inventory reset for business_id %s, year %s, month %s, week %s", business_id, year, month, week)
+
+def apply_stock_changes(c, business_id, user_id, changes):
+    # changes maps (year, month, week) to {ingredient: delta}. Applies every delta
+    # in one executemany (adding rows for ingredients new to the week), logs the
+    # additions and refreshes each week's closing snapshot inside the caller's
+    # transaction. Returns {period: balances}.
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    deltas = [(period, ingredient, delta) for period, period_changes in changes.items() for ingredient, delta in period_changes.items() if delta]
+    c.executemany("INSERT INTO inventory (business_id, year, month, week, ingredient, amount) VALUES (?, ?, ?, ?, ?, ?) "
+                  "ON CONFLICT(business_id, year, month, week, ingredient) DO UPDATE SET amount = amount + excluded.amount", 
+                  [(business_id, *period, ingredient, delta) for period, ingredient, delta in deltas])
+    c.executemany("INSERT INTO inventory_transactions (business_id, year, month, week, ingredient, amount_added, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
+                  [(business_id, *period, ingredient, delta, timestamp, user_id) for period, ingredient, delta in deltas if delta > 0])
+    balances = {period: take_snapshot(c, 'closing', business_id, *period) for period in changes}
+    bump_report_version(c, business_id)
+    return balances
 
-def log_sales(daily_sales, user_id, year):
-    conn = sqlite3.connect(DB_NAME)
+def set_inventory_levels(levels, business_id, year, month, week, user_id):
+    # Stock count for one week: diffs the counted amounts against the stored
+    # ones in a single read and applies the differences in bulk
+    conn = get_db()
     c = conn.cursor()
-    date = datetime.now().strftime('%Y-%m-%d')
-    for item, quantity in daily_sales.items():
-        if quantity > 0:
-            c.execute("INSERT INTO sales (user_id, year, item, quantity, date) VALUES (?, ?, ?, ?, ?)", 
-                      (user_id, year, item, quantity, date))
-    conn.commit()
-    conn.close()
-    print(f"Sales logged for user_id {user_id}, year {year}")
-
-def generate_daily_report(total_ingredients, low_stock, business_id, year, month, week):
-    report = StringIO()
-    report.write("Total Ingredients Used Today:\n")
-    for ingredient, amount in total_ingredients.items():
-        report.write(f"{ingredient}: {amount} units\n")
-    if not total_ingredients:
-        report.write("No items were sold today.\n")
-    report.write(f"\nRemaining Inventory for Year {year}, Month {month}, Week {week}:\n")
-    for ingredient, amount in get_inventory(business_id, year, month, week).items():
-        report.write(f"{ingredient}: {amount} units\n")
-    if low_stock:
-        report.write("\nInventory Alerts:\n")
-        for alert in low_stock:
-            report.write(f"{alert}\n")
-    return report.getvalue()
-
-def generate_sales_report(user_id, period, year):
-    conn = sqlite3.connect(DB_NAME)
+    with transaction(conn):
+        c.execute("SELECT ingredient, amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ?", 
+                  (business_id, year, month, week))
+        changes = {ingredient: levels[ingredient] - amount for ingredient, amount in c.fetchall() if ingredient in levels}
+        apply_stock_changes(c, business_id, user_id, {(year, month, week): changes})
+    logger.info("Inventory updated for business_id %s, year %s, month %s, week %s", business_id, year, month, week)
+
+def receive_deliveries(deliveries, business_id, user_id):
+    # deliveries are (year, month, week, ingredient, amount) rows, possibly
+    # spanning many weeks; all of them are added in one transaction
+    changes = {}
+    for year, month, week, ingredient, amount in deliveries:
+        period_changes = changes.setdefault((year, month, week), {})
+        period_changes[ingredient] = period_changes.get(ingredient, 0) + amount
+    conn = get_db()
+    c = conn.cursor()
+    with transaction(conn):
+        for period in changes:
+            seed_week(c, business_id, *period)
+        balances = apply_stock_changes(c, business_id, user_id, changes)
+    logger.info("Recorded %s deliveries across %s weeks for business_id %s", len(deliveries), len(changes), business_id)
+    return balances
+
+def update_sales_rollups(c, sales_data):
+    # sales_data rows are (user_id, year, item, quantity, date) as inserted into sales
+    daily, weekly, monthly = {}, {}, {}
+    for user_id, year, item, quantity, date in sales_data:
+        day = datetime.strptime(date, '%Y-%m-%d')
+        week_start = (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+        for rollup, period in ((daily, date), (weekly, week_start), (monthly, date[:7])):
+            key = (user_id, year, period, item)
+            rollup[key] = rollup.get(key, 0) + quantity
+    for table, column, rollup in (('sales_daily', 'date', daily), ('sales_weekly', 'week_start', weekly), ('sales_monthly', 'month', monthly)):
+        c.executemany(f"INSERT INTO {table} (user_id, year, {column}, item, quantity) VALUES (?, ?, ?, ?, ?) "
+                      f"ON CONFLICT(user_id, year, {column}, item) DO UPDATE SET quantity = quantity + excluded.quantity", 
+                      [(*key, quantity) for key, quantity in rollup.items()])
+
+def fill_sales_rollups(c):
+    c.execute("DELETE FROM sales_daily")
+    c.execute("DELETE FROM sales_weekly")
+    c.execute("DELETE FROM sales_monthly")
+    c.execute("INSERT INTO sales_daily (user_id, year, date, item, quantity) "
+              "SELECT user_id, year, date, item, SUM(quantity) FROM sales GROUP BY user_id, year, date, item")
+    c.execute("INSERT INTO sales_weekly (user_id, year, week_start, item, quantity) "
+              "SELECT user_id, year, date(date, '-' || ((CAST(strftime('%w', date) AS INTEGER) + 6) % 7) || ' days'), item, SUM(quantity) "
+              "FROM sales_daily GROUP BY 1, 2, 3, 4")
+    c.execute("INSERT INTO sales_monthly (user_id, year, month, item, quantity) "
+              "SELECT user_id, year, substr(date, 1, 7), item, SUM(quantity) FROM sales_daily GROUP BY 1, 2, 3, 4")
+
+def rebuild_sales_rollups():
+    conn = get_db()
+    c = conn.cursor()
+    with transaction(conn):
+        fill_sales_rollups(c)
+        # The refill already counts sales whose 'sale' job is still queued, so
+        # those jobs keep their snapshot and report work but add no rollups
+        c.execute("UPDATE jobs SET payload = json_set(payload, '$.sales', json('[]')) WHERE kind = 'sale' AND status = 'queued'")
+        c.execute("UPDATE report_versions SET version = version + 1")
+    logger.info("Sales rollups rebuilt from the sales table")
+
+def log_sales(daily_sales, user_id):
+    # Sales are filed under the calendar year of their date, like the bulk
+    # import; only inventory periods use the ISO year
+    conn = get_db()
+    c = conn.cursor()
+    now = datetime.now()
+    year, date = now.year, now.strftime('%Y-%m-%d')
+    sales_data = [(user_id, year, item, quantity, date) for item, quantity in daily_sales.items() if quantity > 0]
+    with transaction(conn):
+        c.executemany("INSERT INTO sales (user_id, year, item, quantity, date) VALUES (?, ?, ?, ?, ?)", sales_data)
+    logger.info("Sales logged for user_id %s, year %s", user_id, year)
+    return sales_data
+
+@job_queue.handler('sale')
+def finish_sale(user_id, business_id, year, month, week, sales):
+    # The bookkeeping a sale needs but the till does not wait for: sales
+    # rollups, the week's closing snapshot and a fresh daily report
+    c = get_db().cursor()
+    update_sales_rollups(c, [tuple(row) for row in sales])
+    take_snapshot(c, 'closing', business_id, year, month, week)
+    bump_report_version(c, business_id)
+    try:
+        # Queued separately so it renders from committed data under the new version
+        job_queue.enqueue(c, 'daily_report', user_id=user_id, business_id=business_id, year=year, month=month, week=week)
+    except QueueFull:
+        pass
+
+@job_queue.handler('daily_report')
+def warm_daily_report(user_id, business_id, year, month, week):
+    get_daily_report(user_id, business_id, year, month, week)
+
+def record_sale(daily_sales, total_ingredients, user_id, business_id, year, month, week):
+    # Validate, decrement stock and log the sale in one transaction with a
+    # single commit. Returns (insufficient, low_stock, remaining inventory);
+    # nothing is written when insufficient is non-empty. Inside an open
+    # transaction the sale runs in a savepoint, so a rejected sale leaves the
+    # caller's other writes in place. Rollups and snapshots are queued in the
+    # same transaction, or done inline when the job queue is backed up.
+    conn = get_db()
+    try:
+        with transaction(conn), savepoint(conn, 'sale'):
+            c = conn.cursor()
+            low_stock, inventory = update_inventory(total_ingredients, business_id, year, month, week, user_id)
+            sales_data = log_sales(daily_sales, user_id)
+            bump_report_version(c, business_id)
+            followup = {'user_id': user_id, 'business_id': business_id, 'year': year, 'month': month, 'week': week, 'sales': sales_data}
+            try:
+                job_queue.enqueue(c, 'sale', **followup)
+            except QueueFull:
+                logger.warning("Job queue full, finishing sale for business_id %s inline", business_id)
+                finish_sale(**followup)
+    except InsufficientInventory:
+        insufficient = check_inventory(total_ingredients, business_id, year, month, week)
+        return insufficient or ["Inventory changed while recording the sale, please try again."], [], None
+    return [], low_stock, inventory
+
+def record_sales_batch(sales, user_id, business_id, idempotency_key=None):
+    # Records a till's batch of sales against the current week in one
+    # transaction; each sale succeeds or fails on its own. With an idempotency
+    # key the response is stored in the same transaction, and a retry with the
+    # same key and payload gets it back instead of deducting stock again.
+    # Returns (status, body, replayed).
+    year, month, week = get_current_period()
+    populate_user_data(user_id, business_id, year, month, week)
+    request_hash = hashlib.sha256(json.dumps(sales, sort_keys=True).encode()).hexdigest()
+    conn = get_db()
     c = conn.cursor()
-    report = StringIO()
+    with transaction(conn):
+        if idempotency_key is not None:
+            c.execute("SELECT request_hash, status, response FROM idempotency_keys WHERE user_id = ? AND key = ?", (user_id, idempotency_key))
+            row = c.fetchone()
+            if row is not None:
+                if row[0] != request_hash:
+                    return 422, {'error': 'Idempotency-Key was already used with a different payload.'}, False
+                return row[1], json.loads(row[2]), True
+        results = []
+        inventory = None
+        for sale in sales:
+            total_ingredients = compute_ingredients(sale, user_id)
+            insufficient, low_stock, remaining = record_sale(sale, total_ingredients, user_id, business_id, year, month, week)
+            results.append({'recorded': not insufficient, 'errors': insufficient, 'ingredients': total_ingredients, 'low_stock': low_stock})
+            inventory = remaining or inventory
+        recorded = sum(result['recorded'] for result in results)
+        status = 409 if recorded == 0 else 200
+        body = {'year': year, 'month': month, 'week': week, 'recorded': recorded, 'rejected': len(results) - recorded,
+                'sales': results, 'inventory': inventory}
+        if idempotency_key is not None:
+            now = datetime.now()
+            expired = now - timedelta(hours=app.config['IDEMPOTENCY_KEY_TTL'])
+            c.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (expired.strftime('%Y-%m-%d %H:%M:%S'),))
+            c.execute("INSERT INTO idempotency_keys (user_id, key, request_hash, status, response, created_at) VALUES (?, ?, ?, ?, ?, ?)", 
+                      (user_id, idempotency_key, request_hash, status, json.dumps(body), now.strftime('%Y-%m-%d %H:%M:%S')))
+    logger.info("Recorded %s of %s API sales for user_id %s", recorded, len(results), user_id)
+    return status, body, False
+
+def import_sales(stream, fmt, user_id, business_id, chunk_size=None, max_rejected_rows=100):
+    # Streams sales rows in chunks; each chunk deducts its ingredients in aggregate
+    # per (year, month, week) and inserts its rows in one bounded transaction.
+    # History is imported even when stock runs out, but the summary lists each
+    # period's ingredients that went negative ('short') or that the week does
+    # not stock at all ('missing', with the amount that could not be deducted).
+    chunk_size = chunk_size or app.config['IMPORT_CHUNK_SIZE']
+    conn = get_db()
+    c = conn.cursor()
+    matrix = get_recipe_matrix(user_id)
+    seeded_periods = set()
+    imported = rejected = 0
+    rejected_rows = []
+    short, missing = {}, {}
+    started = time.perf_counter()
+    for chunk in chunked(iter_rows(stream, fmt), chunk_size):
+        sales_data = []
+        period_sales = {}
+        for line_number, row in chunk:
+            try:
+                date, item, quantity, year = parse_sale(row)
+                if item not in matrix.item_index:
+                    raise ValueError(f"unknown item '{item}'")
+            except ValueError as e:
+                rejected += 1
+                if len(rejected_rows) < max_rejected_rows:
+                    rejected_rows.append({'line': line_number, 'error': str(e)})
+                continue
+            period = period_for_date(date)
+            items = period_sales.setdefault(period, {})
+            items[item] = items.get(item, 0) + quantity
+            sales_data.append((user_id, year, item, quantity, date.strftime('%Y-%m-%d')))
+        usage = []
+        for (year, month, week), requirements in zip(period_sales, matrix.batch_requirements(period_sales.values())):
+            usage.extend((amount, business_id, year, month, week, ingredient) for ingredient, amount in requirements.items())
+        with transaction(conn):
+            for period in period_sales:
+                if period not in seeded_periods:
+                    seed_week(c, business_id, *period)
+                    seeded_periods.add(period)
+            # One statement per period and ingredient, so RETURNING can report the new balance
+            for params in usage:
+                c.execute("UPDATE inventory SET amount = amount - ? WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ? "
+                          "RETURNING amount", params)
+                row = c.fetchone()
+                key = params[2:]
+                if row is None:
+                    missing[key] = missing.get(key, 0) + params[0]
+                elif row[0] < 0:
+                    short[key] = row[0]
+                else:
+                    short.pop(key, None)
+            c.executemany("INSERT INTO sales (user_id, year, item, quantity, date) VALUES (?, ?, ?, ?, ?)", sales_data)
+            update_sales_rollups(c, sales_data)
+            for year, month, week in period_sales:
+                take_snapshot(c, 'closing', business_id, year, month, week)
+            bump_report_version(c, business_id)
+        imported += len(sales_data)
+    elapsed = time.perf_counter() - started
+    logger.info("Imported %s sales (%s rejected) for user_id %s in %.2fs", imported, rejected, user_id, elapsed)
+    if short or missing:
+        logger.warning("Import for business_id %s left %s ingredients short and %s missing", business_id, len(short), len(missing))
+    return {'imported': imported, 'rejected': rejected, 'rejected_rows': rejected_rows,
+            'short': [{'year': year, 'month': month, 'week': week, 'ingredient': ingredient, 'balance': balance}
+                      for (year, month, week, ingredient), balance in short.items()],
+            'missing': [{'year': year, 'month': month, 'week': week, 'ingredient': ingredient, 'unapplied': amount}
+                        for (year, month, week, ingredient), amount in missing.items()],
+            'seconds': round(elapsed, 3), 'rows_per_second': round((imported + rejected) / elapsed, 1) if elapsed else None}
+
+def get_report_version(business_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT version FROM report_versions WHERE business_id = ?", (business_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def get_daily_report(user_id, business_id, year, month, week):
+    # Today's ingredient usage from the daily rollup, the week's remaining stock
+    # and its low-stock alerts, cached until the business's data changes
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    key = ('daily', business_id, user_id, year, month, week, today, get_report_version(business_id))
+    report = report_cache.get(key)
+    if report is not None:
+        return report
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT item, quantity FROM sales_daily WHERE user_id = ? AND year = ? AND date = ?", (user_id, now.year, today))
+    used = compute_ingredients(dict(c.fetchall()), user_id)
+    c.execute("SELECT i.ingredient, i.amount, t.threshold FROM inventory i "
+              "LEFT JOIN reorder_thresholds t ON t.user_id = ? AND t.ingredient = i.ingredient "
+              "WHERE i.business_id = ? AND i.year = ? AND i.month = ? AND i.week = ?", 
+              (user_id, business_id, year, month, week))
+    inventory, alerts = {}, []
+    for ingredient, amount, threshold in c.fetchall():
+        inventory[ingredient] = amount
+        if threshold is not None and amount < threshold:
+            alerts.append(f"{ingredient} is running low ({amount} units left)")
+    report = {'year': year, 'month': month, 'week': week, 'used': used, 'inventory': inventory, 'alerts': alerts}
+    report_cache.set(key, report)
+    return report
+
+SALES_REPORT_PERIODS = ('weekly', 'monthly', 'yearly')
+
+def get_sales_report(user_id, business_id, period, year):
+    # Sales per item from the rollups, cached until the business's data changes
     current_date = datetime.now()
     if period == 'weekly':
         start_date = current_date - timedelta(days=current_date.weekday())
         end_date = start_date + timedelta(days=6)
-        c.execute("SELECT item, SUM(quantity) FROM sales WHERE user_id = ? AND year = ? AND date BETWEEN ? AND ? GROUP BY item",
-                  (user_id, year, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+        sql, params = ("SELECT item, quantity FROM sales_weekly WHERE user_id = ? AND year = ? AND week_start = ? ORDER BY item",
+                       (user_id, year, start_date.strftime('%Y-%m-%d')))
         title = f"Weekly Sales Report ({start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')})"
     elif period == 'monthly':
         start_date = current_date.replace(day=1)
-        end_date = (start_date.replace(month=start_date.month % 12 + 1, day=1) - timedelta(days=1)) if start_date.month < 12 else start_date.replace(year=start_date.year + 1, month=1, day=1) - timedelta(days=1)
-        c.execute("SELECT item, SUM(quantity) FROM sales WHERE user_id = ? AND year = ? AND date BETWEEN ? AND ? GROUP BY item",
-                  (user_id, year, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+        sql, params = ("SELECT item, quantity FROM sales_monthly WHERE user_id = ? AND year = ? AND month = ? ORDER BY item",
+                       (user_id, year, start_date.strftime('%Y-%m')))
         title = f"Monthly Sales Report ({start_date.strftime('%B %Y')})"
     elif period == 'yearly':
-        c.execute("SELECT item, SUM(quantity) FROM sales WHERE user_id = ? AND year = ? GROUP BY item", (user_id, year))
+        sql, params = ("SELECT item, SUM(quantity) FROM sales_monthly WHERE user_id = ? AND year = ? GROUP BY item", (user_id, year))
         title = f"Yearly Sales Report ({year})"
-    rows = c.fetchall()
-    conn.close()
-    report.write(f"{title}:\n")
-    total_sold = 0
-    for item, quantity in rows:
-        report.write(f"{item}: {quantity} units\n")
-        total_sold += quantity
-    if not rows:
-        report.write("No sales recorded.\n")
-    else:
-        report.write(f"\nTotal Items Sold: {total_sold} units\n")
-    return report.getvalue()
+    key = ('sales', business_id, user_id, period, year, title, get_report_version(business_id))
+    report = report_cache.get(key)
+    if report is not None:
+        return report
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(sql, params)
+    items = c.fetchall()
+    report = {'period': period, 'year': year, 'title': title, 'items': items, 'total': sum(quantity for _, quantity in items)}
+    report_cache.set(key, report)
+    return report
+
+def report_download(content, fmt, name):
+    # Reports are rendered in memory and sent as an attachment; nothing touches the disk
+    response = make_response(content)
+    response.headers['Content-Type'] = f"{REPORT_FORMATS[fmt]}; charset=utf-8"
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.{fmt}"'
+    return response
 
 # Routes
 @app.route('/', methods=['GET', 'POST'])
 @login_required
 def home():
-    years = get_years(current_user.business_id)
-    selected_year = request.form.get('year', datetime.now().year, type=int)
-    selected_month = request.form.get('month', datetime.now().month, type=int)
-    selected_week = request.form.get('week', datetime.now().isocalendar()[1], type=int)
-    
-    if selected_year not in years:
-        populate_user_data(current_user.id, current_user.business_id, selected_year, selected_month, selected_week)
-    
-    months = get_months(current_user.business_id, selected_year)
-    weeks = get_weeks(current_user.business_id, selected_year, selected_month)
-    
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT name FROM businesses WHERE id = ?", (current_user.business_id,))
-    business_name = c.fetchone()[0]
-    conn.close()
-    
-    inventory = get_inventory(current_user.business_id, selected_year, selected_month, selected_week)
-    opening_inventory = get_opening_closing_inventory(current_user.business_id, selected_year, 'week', selected_week)
-    transactions = get_inventory_transactions(current_user.business_id, selected_year, selected_month, selected_week)
-    
-    return render_template('home.html', recipes=get_recipes(current_user.id), inventory=inventory, 
-                           opening_inventory=opening_inventory, transactions=transactions,
-                           username=current_user.username, years=years, months=months, weeks=weeks,
-                           selected_year=selected_year, selected_month=selected_month, selected_week=selected_week,
-                           role=current_user.role, business_name=business_name)
+    year, month, week = get_current_period()
+    selected_year = request.form.get('year', year, type=int)
+    selected_month = request.form.get('month', month, type=int)
+    selected_week = request.form.get('week', week, type=int)
+    dashboard, timings = load_dashboard(current_user.id, current_user.business_id, selected_year, selected_month, selected_week)
+    # Sales reports go by calendar year, so the current ISO year maps to today's
+    report_year = datetime.now().year if selected_year == year else selected_year
+    started = time.perf_counter()
+    response = make_response(render_template('home.html', **dashboard,
+                             username=current_user.username,
+                             selected_year=selected_year, selected_month=selected_month, selected_week=selected_week,
+                             report_year=report_year,
+                             role=current_user.role))
+    timings.append(('render', time.perf_counter() - started))
+    response.headers['Server-Timing'] = ', '.join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings)
+    return response
 
 @app.route('/sales', methods=['GET', 'POST'])
 @login_required
 def sales():
     recipes = get_recipes(current_user.id)
     years = get_years(current_user.business_id)
-    selected_year = request.args.get('year', datetime.now().year, type=int)
-    selected_month = request.args.get('month', datetime.now().month, type=int)
-    selected_week = request.args.get('week', datetime.now().isocalendar()[1], type=int)
-    from datetime import datetime as dt
+    year, month, week = get_current_period()
+    selected_year = request.args.get('year', year, type=int)
+    selected_month = request.args.get('month', month, type=int)
+    selected_week = request.args.get('week', week, type=int)
     if request.method == 'POST':
+        # Sales always go against the current week; the year picks its
+        # inventory period, while the sales rows take their date's calendar year
         selected_year = int(request.form.get('year'))
-        selected_month = dt.today().month
-        selected_week = dt.now().isocalendar()[1]
+        selected_month = month
+        selected_week = week
         daily_sales = {item: int(request.form.get(item, 0)) for item in recipes.keys()}
         total_ingredients = compute_ingredients(daily_sales, current_user.id)
-        insufficient = check_inventory(total_ingredients, current_user.business_id, selected_year, selected_month, selected_week)
+        insufficient, low_stock, inventory = record_sale(daily_sales, total_ingredients, current_user.id, current_user.business_id, 
+                                                         selected_year, selected_month, selected_week)
         if insufficient:
             for msg in insufficient:
                 flash(msg)
             return render_template('sales.html', items=recipes.keys(), years=years, selected_year=selected_year, 
                                    selected_month=selected_month, selected_week=selected_week)
-        low_stock = update_inventory(total_ingredients, current_user.business_id, selected_year, selected_month, selected_week)
-        log_sales(daily_sales, current_user.id, selected_year)
-        report = generate_daily_report(total_ingredients, low_stock, current_user.business_id, selected_year, selected_month, selected_week)
-        with open(f'daily_report_{current_user.id}_{selected_year}_{selected_month}_{selected_week}.txt', 'w') as f:
-            f.write(report)
+        # Rendered from the sale itself; today's totals catch up once its job has run
+        report = render_daily_report({'title': 'Ingredients Used by This Sale', 'year': selected_year, 'month': selected_month, 
+                                      'week': selected_week, 'used': total_ingredients, 'inventory': inventory, 'alerts': low_stock})
         return render_template('report.html', report=report.split('\n'), year=selected_year, month=selected_month, week=selected_week)
     return render_template('sales.html', items=recipes.keys(), years=years, selected_year=selected_year, 
                            selected_month=selected_month, selected_week=selected_week)
 
+@app.route('/sales/import', methods=['POST'])
+@login_required
+def sales_import():
+    if current_user.role != 'admin':
+        return jsonify(error='Only admins can import sales.'), 403
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or request.form.get('format') or detect_format(upload.filename if upload else None)
+    if fmt not in FORMATS:
+        return jsonify(error=f"Unsupported format '{fmt}', expected one of {', '.join(FORMATS)}."), 400
+    chunk_size = request.args.get('chunk_size', type=int)
+    if chunk_size is not None and chunk_size < 1:
+        return jsonify(error='chunk_size must be a positive integer.'), 400
+    # Either a multipart upload or the raw request body, read incrementally
+    stream = TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8', newline='')
+    summary = import_sales(stream, fmt, current_user.id, current_user.business_id, chunk_size)
+    return jsonify(summary)
+
+@app.route('/plan', methods=['POST'])
+@login_required
+def plan():
+    data = request.get_json(silent=True) or {}
+    scenarios = data.get('scenarios')
+    if not isinstance(scenarios, list) or not all(isinstance(s, dict) for s in scenarios):
+        return jsonify(error='Expected a JSON body with a "scenarios" list of {item: quantity} objects.'), 400
+    year, month, week = get_current_period()
+    try:
+        scenarios = [{item: int(quantity) for item, quantity in s.items()} for s in scenarios]
+        year = int(data.get('year', year))
+        month = int(data.get('month', month))
+        week = int(data.get('week', week))
+    except (TypeError, ValueError):
+        return jsonify(error='Quantities, year, month and week must be integers.'), 400
+    recipes = get_recipes(current_user.id)
+    for i, scenario in enumerate(scenarios):
+        unknown = [item for item in scenario if item not in recipes]
+        if unknown:
+            return jsonify(error=f"Scenario {i}: unknown items: {', '.join(unknown)}."), 400
+    inventory, results = plan_production(scenarios, current_user.id, current_user.business_id, year, month, week)
+    return jsonify(year=year, month=month, week=week, inventory=inventory, scenarios=results)
+
 @app.route('/download_report')
 @login_required
 def download_report():
-    year = request.args.get('year', datetime.now().year, type=int)
-    month = request.args.get('month', datetime.now().month, type=int)
-    week = request.args.get('week', datetime.now().isocalendar()[1], type=int)
-    return send_file(f'daily_report_{current_user.id}_{year}_{month}_{week}.txt', as_attachment=True, 
-                     download_name=f'daily_report_{year}_{month}_{week}.txt')
+    year, month, week = get_current_period()
+    year = request.args.get('year', year, type=int)
+    month = request.args.get('month', month, type=int)
+    week = request.args.get('week', week, type=int)
+    fmt = request.args.get('format', 'txt')
+    if fmt not in REPORT_FORMATS:
+        abort(400)
+    report = get_daily_report(current_user.id, current_user.business_id, year, month, week)
+    return report_download(render_daily_report(report, fmt), fmt, f'daily_report_{year}_{month}_{week}')
 
 @app.route('/sales_report/<period>', methods=['GET', 'POST'])
 @login_required
 def sales_report(period):
+    if period not in SALES_REPORT_PERIODS:
+        abort(404)
     years = get_years(current_user.business_id)
-    selected_year = request.form.get('year', datetime.now().year, type=int) if request.method == 'POST' else request.args.get('year', datetime.now().year, type=int)
-    report = generate_sales_report(current_user.id, period, selected_year)
+    # Sales are kept by calendar year, not the ISO year of the inventory periods
+    year = datetime.now().year
+    selected_year = request.form.get('year', year, type=int) if request.method == 'POST' else request.args.get('year', year, type=int)
+    report = get_sales_report(current_user.id, current_user.business_id, period, selected_year)
     if request.method == 'POST' and 'download' in request.form:
-        with open(f'{period}_report_{current_user.id}_{selected_year}.txt', 'w') as f:
-            f.write(report)
-        return send_file(f'{period}_report_{current_user.id}_{selected_year}.txt', as_attachment=True, 
-                         download_name=f'{period}_report_{selected_year}.txt')
+        fmt = request.form.get('format', 'txt')
+        if fmt not in REPORT_FORMATS:
+            abort(400)
+        return report_download(render_sales_report(report, fmt), fmt, f'{period}_report_{selected_year}')
+    report = render_sales_report(report)
     return render_template('sales_report.html', report=report.split('\n'), period=period.capitalize(), years=years, selected_year=selected_year)
 
+# JSON API for tills; same session login as the web pages
+MAX_API_SALES = 100
+
+@app.route('/api/sales', methods=['POST'])
+@login_required
+def api_sales():
+    data = request.get_json(silent=True)
+    sales = data.get('sales') if isinstance(data, dict) else None
+    if not isinstance(sales, list) or not sales or not all(isinstance(sale, dict) for sale in sales):
+        return jsonify(error='Expected a JSON body with a non-empty "sales" list of {item: quantity} objects.'), 400
+    if len(sales) > MAX_API_SALES:
+        return jsonify(error=f"At most {MAX_API_SALES} sales per request."), 400
+    recipes = get_recipes(current_user.id)
+    for i, sale in enumerate(sales, start=1):
+        unknown = [item for item in sale if item not in recipes]
+        if unknown:
+            return jsonify(error=f"Unknown items: {', '.join(unknown)}."), 400
+        if not all(isinstance(quantity, int) and not isinstance(quantity, bool) and quantity >= 0 for quantity in sale.values()):
+            return jsonify(error='Quantities must be non-negative integers.'), 400
+        # An empty or all-zero sale would deduct and log nothing yet count as recorded
+        if not any(sale.values()):
+            return jsonify(error=f"Sale {i} has no positive quantities."), 400
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+        return jsonify(error='Idempotency-Key must be 1 to 255 characters.'), 400
+    status, body, replayed = record_sales_batch(sales, current_user.id, current_user.business_id, idempotency_key)
+    response = jsonify(body)
+    response.status_code = status
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.route('/api/inventory')
+@login_required
+def api_inventory():
+    # The current week by default; ?year=, ?year=&month= or ?year=&week= for other periods
+    year, month, week = get_current_period()
+    if request.args:
+        year = request.args.get('year', year, type=int)
+        month = request.args.get('month', type=int)
+        week = request.args.get('week', type=int)
+        if week is not None:
+            month = week_month(year, week)
+    inventory = get_inventory(current_user.business_id, year, month, week)
+    return jsonify(year=year, month=month, week=week, inventory=inventory)
+
+@app.route('/api/reports/<period>')
+@login_required
+def api_reports(period):
+    year, month, week = get_current_period()
+    if period == 'daily':
+        year = request.args.get('year', year, type=int)
+        month = request.args.get('month', month, type=int)
+        week = request.args.get('week', week, type=int)
+        report = render_daily_report(get_daily_report(current_user.id, current_user.business_id, year, month, week), 'json')
+    elif period in SALES_REPORT_PERIODS:
+        # Sales are kept by calendar year, not the ISO year of the inventory periods
+        year = request.args.get('year', datetime.now().year, type=int)
+        report = render_sales_report(get_sales_report(current_user.id, current_user.business_id, period, year), 'json')
+    else:
+        return jsonify(error=f"Unknown report period '{period}'."), 404
+    return report, 200, {'Content-Type': 'application/json'}
+
 @app.route('/add_recipe', methods=['GET', 'POST'])
 @login_required
 def add_recipe():
@@ -462,20 +1398,21 @@ def add_recipe():
         return redirect('/')
     if request.method == 'POST':
         name = request.form['name']
-        ingredients = {key: int(request.form.get(key, 0)) for key in ['flour', 'water', 'yeast', 'salt', 'sugar', 'eggs', 'butter', 'chocolate']}
-        conn = sqlite3.connect(DB_NAME)
+        ingredients = recipe_form_amounts(request.form)
+        conn = get_db()
         c = conn.cursor()
         try:
-            c.execute("INSERT INTO recipes (user_id, name, flour, water, yeast, salt, sugar, eggs, butter, chocolate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                      (current_user.id, name, *ingredients.values()))
-            conn.commit()
-            print(f"Recipe '{name}' added for user_id {current_user.id}")
+            with transaction(conn):
+                c.execute("INSERT INTO recipes (user_id, name) VALUES (?, ?)", (current_user.id, name))
+                save_recipe_ingredients(c, c.lastrowid, ingredients)
+                refresh_reorder_thresholds(current_user.id)
+                bump_recipe_version(c, current_user.id)
+            logger.info("Recipe '%s' added for user_id %s", name, current_user.id)
             flash(f"Recipe '{name}' added successfully.")
         except sqlite3.IntegrityError:
             flash('Recipe name already exists.')
-        conn.close()
         return redirect('/')
-    return render_template('add_recipe.html')
+    return render_template('add_recipe.html', ingredients=get_ingredient_names())
 
 @app.route('/edit_recipe/<recipe_name>', methods=['GET', 'POST'])
 @login_required
@@ -488,17 +1425,20 @@ def edit_recipe(recipe_name):
         flash('Recipe not found.')
         return redirect('/')
     if request.method == 'POST':
-        ingredients = {key: int(request.form.get(key, 0)) for key in ['flour', 'water', 'yeast', 'salt', 'sugar', 'eggs', 'butter', 'chocolate']}
-        conn = sqlite3.connect(DB_NAME)
+        ingredients = recipe_form_amounts(request.form)
+        conn = get_db()
         c = conn.cursor()
-        c.execute("UPDATE recipes SET flour=?, water=?, yeast=?, salt=?, sugar=?, eggs=?, butter=?, chocolate=? WHERE user_id=? AND name=?", 
-                  (*ingredients.values(), current_user.id, recipe_name))
-        conn.commit()
-        conn.close()
-        print(f"Recipe '{recipe_name}' updated for user_id {current_user.id}")
+        with transaction(conn):
+            c.execute("SELECT id FROM recipes WHERE user_id = ? AND name = ?", (current_user.id, recipe_name))
+            save_recipe_ingredients(c, c.fetchone()[0], ingredients)
+            refresh_reorder_thresholds(current_user.id)
+            bump_recipe_version(c, current_user.id)
+        logger.info("Recipe '%s' updated for user_id %s", recipe_name, current_user.id)
         flash(f"Recipe '{recipe_name}' updated successfully.")
         return redirect('/')
-    return render_template('edit_recipe.html', recipe_name=recipe_name, ingredients=recipes[recipe_name])
+    # Every dictionary ingredient, so the form can add ones the recipe does not use yet
+    ingredients = {name: recipes[recipe_name].get(name, 0) for name in get_ingredient_names()}
+    return render_template('edit_recipe.html', recipe_name=recipe_name, ingredients=ingredients)
 
 @app.route('/update_inventory', methods=['GET', 'POST'])
 @login_required
@@ -507,36 +1447,61 @@ def update_inventory_route():
         flash('Only admins can update inventory.')
         return redirect('/')
     years = get_years(current_user.business_id)
-    selected_year = request.args.get('year', datetime.now().year, type=int)
-    selected_month = request.args.get('month', datetime.now().month, type=int)
-    selected_week = request.args.get('week', datetime.now().isocalendar()[1], type=int)
+    year, month, week = get_current_period()
+    selected_year = request.args.get('year', year, type=int)
+    selected_month = request.args.get('month', month, type=int)
+    selected_week = request.args.get('week', week, type=int)
     
     if request.method == 'POST':
         selected_year = int(request.form.get('year'))
         selected_month = int(request.form.get('month'))
         selected_week = int(request.form.get('week'))
-        inventory_updates = {key: int(request.form.get(key, 0)) for key in get_inventory(current_user.business_id, selected_year, selected_month, selected_week).keys()}
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        for ingredient, new_amount in inventory_updates.items():
-            c.execute("SELECT amount FROM inventory WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ?", 
-                      (current_user.business_id, selected_year, selected_month, selected_week, ingredient))
-            old_amount = c.fetchone()[0]
-            amount_added = new_amount - old_amount
-            c.execute("UPDATE inventory SET amount = ? WHERE business_id = ? AND year = ? AND month = ? AND week = ? AND ingredient = ?", 
-                      (new_amount, current_user.business_id, selected_year, selected_month, selected_week, ingredient))
-            if amount_added > 0:
-                c.execute("INSERT INTO inventory_transactions (business_id, year, month, week, ingredient, amount_added, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
-                          (current_user.business_id, selected_year, selected_month, selected_week, ingredient, amount_added, timestamp, current_user.id))
-        conn.commit()
-        conn.close()
-        print(f"Inventory updated for business_id {current_user.business_id}, year {selected_year}, month {selected_month}, week {selected_week}")
+        levels = {key: int(value) for key, value in request.form.items() if key not in ('year', 'month', 'week')}
+        set_inventory_levels(levels, current_user.business_id, selected_year, selected_month, selected_week, current_user.id)
         flash("Inventory updated successfully.")
         return redirect('/')
     return render_template('update_inventory.html', inventory=get_inventory(current_user.business_id, selected_year, selected_month, selected_week), 
                            years=years, selected_year=selected_year, selected_month=selected_month, selected_week=selected_week)
 
+@app.route('/update_inventory/manifest', methods=['POST'])
+@login_required
+def inventory_manifest():
+    # Supplier delivery manifest: a JSON list (or {"deliveries": [...]}), CSV or
+    # JSONL of year, week, ingredient, amount rows with an optional month.
+    # Applied all or nothing.
+    if current_user.role != 'admin':
+        return jsonify(error='Only admins can record deliveries.'), 403
+    if request.is_json:
+        data = request.get_json(silent=True)
+        rows = data.get('deliveries') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            return jsonify(error='Expected a JSON list of deliveries or an object with a "deliveries" list.'), 400
+        rows = enumerate(rows, 1)
+    else:
+        upload = request.files.get('file')
+        fmt = request.args.get('format') or request.form.get('format') or detect_format(upload.filename if upload else None)
+        if fmt not in FORMATS:
+            return jsonify(error=f"Unsupported format '{fmt}', expected json or one of {', '.join(FORMATS)}."), 400
+        rows = iter_rows(TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8', newline=''), fmt)
+    known = set(get_ingredient_names())
+    deliveries, rejected_rows = [], []
+    for line_number, row in rows:
+        try:
+            delivery = parse_delivery(row)
+            if delivery[3] not in known:
+                raise ValueError(f"unknown ingredient '{delivery[3]}'")
+        except ValueError as e:
+            rejected_rows.append({'line': line_number, 'error': str(e)})
+            continue
+        deliveries.append(delivery)
+    if rejected_rows:
+        return jsonify(error='The manifest was not applied.', rejected_rows=rejected_rows[:100]), 400
+    if not deliveries:
+        return jsonify(error='The manifest has no deliveries.'), 400
+    balances = receive_deliveries(deliveries, current_user.business_id, current_user.id)
+    return jsonify(applied=len(deliveries), periods=[{'year': year, 'month': month, 'week': week, 'inventory': inventory} 
+                                                     for (year, month, week), inventory in balances.items()])
+
 @app.route('/reset_inventory/<int:year>/<int:month>/<int:week>', methods=['POST'])
 @login_required
 def reset_inventory_route(year, month, week):
@@ -560,23 +1525,47 @@ def manage_users():
         if role not in ['admin', 'user']:
             flash('Invalid role selected.')
             return redirect('/manage_users')
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_directory_db()
         c = conn.cursor()
         try:
             c.execute("INSERT INTO users (username, password, role, business_id) VALUES (?, ?, ?, ?)", 
                       (username, generate_password_hash(password), role, current_user.business_id))
             conn.commit()
-            print(f"User '{username}' added with role '{role}' for business_id {current_user.business_id}")
+            logger.info("User '%s' added with role '%s' for business_id %s", username, role, current_user.business_id)
             flash(f'User {username} created successfully.')
         except sqlite3.IntegrityError:
             flash('Username already exists in this business.')
         c.execute("SELECT id, username, role FROM users WHERE business_id = ? AND id != ?", (current_user.business_id, current_user.id))
         users = c.fetchall()
-        conn.close()
         return render_template('manage_users.html', users=users, business_id=current_user.business_id)
     users = get_users(current_user.business_id)
     return render_template('manage_users.html', users=users, business_id=current_user.business_id)
 
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    if current_user.role != 'admin':
+        flash('Only admins can view cache statistics.')
+        return redirect('/')
+    return jsonify(recipes=recipe_cache.stats(), recipe_matrices=matrix_cache.stats(), users=user_cache.stats(), reports=report_cache.stats())
+
+@app.route('/metrics')
+@login_required
+def metrics_endpoint():
+    if current_user.role != 'admin':
+        return 'Only admins can view metrics.\n', 403, {'Content-Type': 'text/plain; charset=utf-8'}
+    caches = {'recipes': recipe_cache.stats(), 'recipe_matrices': matrix_cache.stats(), 'users': user_cache.stats(), 'reports': report_cache.stats()}
+    return metrics.render(caches), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/jobs')
+@login_required
+def jobs_status():
+    if current_user.role != 'admin':
+        flash('Only admins can view background jobs.')
+        return redirect('/')
+    return render_template('jobs.html', stats=job_queue.stats(), jobs=job_queue.recent(), workers=app.config['JOB_WORKERS'],
+                           max_pending=app.config['JOB_MAX_PENDING'])
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     businesses = get_businesses()
@@ -584,15 +1573,14 @@ def login():
         username = request.form['username']
         password = request.form['password']
         business_id = int(request.form['business_id'])
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_directory_db()
         c = conn.cursor()
         c.execute("SELECT id, username, password, role, business_id FROM users WHERE username = ? AND business_id = ?", (username, business_id))
         user = c.fetchone()
-        conn.close()
         if user and check_password_hash(user[2], password):
             login_user(User(user[0], user[1], user[3], user[4]))
             populate_user_data(current_user.id, current_user.business_id)
-            print(f"User '{username}' logged in for business_id {business_id}")
+            logger.info("User '%s' logged in for business_id %s", username, business_id)
             return redirect('/')
         flash('Invalid username, password, or business')
     return render_template('login.html', businesses=businesses)
@@ -603,7 +1591,178 @@ def logout():
     logout_user()
     return redirect('/login')
 
+@app.cli.command('import-sales')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--username', required=True, help='User the sales are recorded for.')
+@click.option('--business-id', type=int, default=1, show_default=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', type=click.IntRange(min=1), help='Rows per transaction.')
+def import_sales_command(path, username, business_id, fmt, chunk_size):
+    """Import sales from a CSV or JSONL file with date, item and quantity columns."""
+    c = get_directory_db().cursor()
+    c.execute("SELECT id FROM users WHERE username = ? AND business_id = ?", (username, business_id))
+    user = c.fetchone()
+    if user is None:
+        raise click.ClickException(f"No user '{username}' in business {business_id}")
+    with open(path, encoding='utf-8', newline='') as f, use_business(business_id):
+        summary = import_sales(f, fmt or detect_format(path), user[0], business_id, chunk_size)
+    click.echo(f"Imported {summary['imported']} rows, rejected {summary['rejected']} "
+               f"in {summary['seconds']}s ({summary['rows_per_second']} rows/s)")
+    for rejected_row in summary['rejected_rows']:
+        click.echo(f"  line {rejected_row['line']}: {rejected_row['error']}")
+    for row in summary['short']:
+        click.echo(f"  short: {row['ingredient']} at {row['balance']} in week {row['week']} of {row['year']}")
+    for row in summary['missing']:
+        click.echo(f"  missing: {row['ingredient']} not stocked in week {row['week']} of {row['year']}, {row['unapplied']} not deducted")
+
+@app.cli.command('audit-queries')
+def audit_queries_command():
+    """Run EXPLAIN QUERY PLAN over the hot queries and report table scans."""
+    problems = audit_query_plans()
+    if not problems:
+        click.echo(f"All {len(HOT_QUERIES)} hot queries use an index.")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Rebuild the daily, weekly and monthly sales rollups from the sales table."""
+    for scope in tenant_scopes():
+        with use_business(scope):
+            rebuild_sales_rollups()
+
+@app.cli.command('close-period')
+@click.option('--business-id', type=int, help='Defaults to every business with stock in the week.')
+@click.option('--year', type=int, help='ISO year; defaults to the previous week.')
+@click.option('--week', type=int, help='ISO week; defaults to the previous week.')
+def close_period_command(business_id, year, week):
+    """Close an ISO week and carry its closing balances into the next week."""
+    if (year is None) != (week is None):
+        raise click.ClickException('Pass both --year and --week, or neither.')
+    if year is None:
+        year, _, week = period_for_date(datetime.now().date() - timedelta(weeks=1))
+    if business_id is None:
+        business_ids = []
+        for scope in tenant_scopes():
+            with use_business(scope):
+                c = get_db().cursor()
+                c.execute("SELECT DISTINCT business_id FROM inventory WHERE year = ? AND month = ? AND week = ?", (year, week_month(year, week), week))
+                business_ids.extend(row[0] for row in c.fetchall())
+        if not business_ids:
+            click.echo(f"No business has stock in week {week} of {year}")
+    else:
+        business_ids = [business_id]
+    for business_id in business_ids:
+        with use_business(business_id):
+            closing = close_period(business_id, year, week)
+        if closing:
+            click.echo(f"Closed week {week} of {year} for business {business_id} ({len(closing)} ingredients carried forward)")
+        else:
+            click.echo(f"Business {business_id} has no stock in week {week} of {year}")
+
+@app.cli.command('forecast')
+@click.option('--business-id', type=int, help='Defaults to every business.')
+def forecast_command(business_id):
+    """Rebuild next week's demand forecast and reorder list; run nightly."""
+    business_ids = [business_id] if business_id is not None else list(get_businesses())
+    for business_id in business_ids:
+        with use_business(business_id):
+            rows = build_forecast(business_id)
+        reorders = [row for row in rows if row['reorder']]
+        click.echo(f"Business {business_id}: {len(rows)} ingredients forecast, {len(reorders)} to reorder")
+        for row in reorders:
+            click.echo(f"  {row['ingredient']}: order {row['reorder']} (need {row['demand']}, have {row['on_hand']})")
+
+# Per-business rows copied into shard files by `flask split-shards`, in copy
+# order, with the filter that selects one business's rows from the source
+# database (attached as src). Reference tables without a filter are copied whole.
+BUSINESS_USERS = "SELECT id FROM src.users WHERE business_id = :business_id"
+SHARD_TABLES = [
+    ('ingredients', None),
+    ('initial_inventory', None),
+    ('recipes', f"user_id IN ({BUSINESS_USERS})"),
+    ('recipe_ingredients', f"recipe_id IN (SELECT id FROM src.recipes WHERE user_id IN ({BUSINESS_USERS}))"),
+    ('reorder_thresholds', f"user_id IN ({BUSINESS_USERS})"),
+    ('inventory', "business_id = :business_id"),
+    ('inventory_snapshots', "business_id = :business_id"),
+    ('inventory_transactions', "business_id = :business_id"),
+    ('sales', f"user_id IN ({BUSINESS_USERS})"),
+    ('sales_daily', f"user_id IN ({BUSINESS_USERS})"),
+    ('sales_weekly', f"user_id IN ({BUSINESS_USERS})"),
+    ('sales_monthly', f"user_id IN ({BUSINESS_USERS})"),
+    ('idempotency_keys', f"user_id IN ({BUSINESS_USERS})"),
+    ('forecasts', "business_id = :business_id"),
+    ('report_versions', "business_id = :business_id"),
+    ('recipe_versions', f"user_id IN ({BUSINESS_USERS})"),
+    ('jobs', "status = 'queued' AND json_extract(payload, '$.business_id') = :business_id"),
+]
+
+def split_business(business_id, prune=False):
+    # Copies one business's rows from DB_NAME into its shard file in one
+    # transaction; with prune, then deletes them from DB_NAME. Returns rows
+    # copied, or None when the shard already holds data for the business.
+    with use_business(business_id):
+        conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT EXISTS (SELECT 1 FROM recipes) OR EXISTS (SELECT 1 FROM inventory) OR EXISTS (SELECT 1 FROM sales)")
+    if c.fetchone()[0]:
+        return None
+    c.execute("ATTACH DATABASE ? AS src", (app.config['DB_NAME'],))
+    try:
+        copied = 0
+        with transaction(conn):
+            for table, condition in SHARD_TABLES:
+                c.execute(f"SELECT name FROM pragma_table_info('{table}')")
+                columns = ', '.join(row[0] for row in c.fetchall())
+                c.execute(f"DELETE FROM main.{table}")
+                c.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}"
+                          + (f" WHERE {condition}" if condition else ""), {'business_id': business_id})
+                copied += c.rowcount
+    finally:
+        c.execute("DETACH DATABASE src")
+    if prune:
+        conn = get_directory_db()
+        c = conn.cursor()
+        with transaction(conn):
+            # Children first, so the recipe filter still finds its parents
+            for table, condition in reversed(SHARD_TABLES):
+                if condition:
+                    c.execute(f"DELETE FROM {table} WHERE {condition.replace('src.', '')}", {'business_id': business_id})
+    logger.info("Split %s rows for business_id %s into %s", copied, business_id, db_path(business_id))
+    return copied
+
+@app.cli.command('split-shards')
+@click.option('--business-id', type=int, help='Defaults to every business.')
+@click.option('--prune', is_flag=True, help='Delete the copied rows from the main database afterwards.')
+def split_shards_command(business_id, prune):
+    """Move each business's data from the main database into its own shard file under SHARD_DIR."""
+    if not app.config['SHARD_DIR']:
+        raise click.ClickException('Set SHARD_DIR (BAKERS_SHARD_DIR) to the directory for the shard files.')
+    os.makedirs(app.config['SHARD_DIR'], exist_ok=True)
+    init_db()
+    business_ids = [business_id] if business_id is not None else list(get_businesses())
+    for business_id in business_ids:
+        copied = split_business(business_id, prune)
+        if copied is None:
+            click.echo(f"Business {business_id}: {db_path(business_id)} already has data, skipped")
+        else:
+            click.echo(f"Business {business_id}: copied {copied} rows into {db_path(business_id)}")
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring the main database and every shard up to the latest schema version."""
+    init_db()
+    click.echo(f"Schema version {len(MIGRATIONS)}")
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run every queued background job in this process, then exit."""
+    ran = job_queue.run_pending()
+    stats = job_queue.stats()
+    click.echo(f"Ran {ran} jobs; {stats['queued']} queued, {stats['failed']} failed")
+
 # Initialize app
 if __name__ == '__main__':
-    init_db()
+    with app.app_context():
+        init_db()
+    # Pick up jobs left queued by a previous run
+    job_queue.start()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import atexit
+import json
+import logging
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from flask import g, has_request_context, request
+
+logger = logging.getLogger('bakers_assist')
+
+class RequestIdFilter(logging.Filter):
+    # Runs in the request's thread before the record is queued, while g is still available
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging(app):
+    # Records are formatted and written by a listener thread, so a request
+    # only pays for putting the record on a queue.
+    level = app.config.get('LOG_LEVEL', 'INFO')
+    output = logging.StreamHandler(sys.stderr)
+    if app.config.get('LOG_FORMAT') == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    log_queue = SimpleQueue()
+    handler = QueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    logger.setLevel(level)
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+    @app.before_request
+    def assign_request_id():
+        # Reuse the caller's correlation id when a proxy or till sends one
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+    @app.after_request
+    def return_request_id(response):
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        return response
+
+    return listener
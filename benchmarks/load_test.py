@@ -0,0 +1,174 @@
+"""Load test for the core routes.
+
+Seeds a throwaway database (businesses, users, recipes and years of sales
+history) and then drives /login, /, /sales, /sales_report/<period> and
+/update_inventory through Flask test clients from concurrent threads,
+reporting p50/p95/p99 latency per route and overall throughput.
+
+    python benchmarks/load_test.py --businesses 3 --users 4 --recipes 10 --years 2 --threads 8 --iterations 50
+
+Pass --max-p95 (milliseconds) to exit non-zero when any route is slower,
+so the script can gate regressions in CI.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+PASSWORD = 'benchpass'
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def seed(bakers, client_factory, args):
+    from werkzeug.security import generate_password_hash
+    rng = random.Random(args.seed)
+    year, month, week = bakers.get_current_period()
+    accounts = []
+    with bakers.app.app_context():
+        bakers.init_db()
+        conn = bakers.get_directory_db()
+        # Cheap hashes keep seeding fast; login still goes through check_password_hash
+        password = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1000')
+        for b in range(args.businesses):
+            conn.execute("INSERT INTO businesses (name) VALUES (?)", (f"Bench Bakery {b}",))
+            business_id = conn.execute("SELECT id FROM businesses WHERE name = ?", (f"Bench Bakery {b}",)).fetchone()[0]
+            for u in range(args.users):
+                role = 'admin' if u == 0 else 'user'
+                conn.execute("INSERT INTO users (username, password, role, business_id) VALUES (?, ?, ?, ?)",
+                             (f"baker{u}", password, role, business_id))
+                user_id = conn.execute("SELECT id FROM users WHERE username = ? AND business_id = ?",
+                                       (f"baker{u}", business_id)).fetchone()[0]
+                accounts.append({'username': f"baker{u}", 'business_id': business_id, 'user_id': user_id, 'role': role})
+            conn.commit()
+        ingredients = [row[0] for row in conn.execute("SELECT ingredient FROM initial_inventory")]
+
+    # Extra recipes go through the real route so seeding follows the schema
+    for account in accounts:
+        client = client_factory()
+        client.post('/login', data={'username': account['username'], 'password': PASSWORD, 'business_id': account['business_id']})
+        account['items'] = ['Bread', 'Cake', 'Cookies']
+        if account['role'] == 'admin':
+            for r in range(args.recipes):
+                name = f"Recipe {r}"
+                amounts = {ingredient: rng.choice([0, 0, 5, 10, 50, 100]) for ingredient in ingredients}
+                client.post('/add_recipe', data={'name': name, **amounts})
+                account['items'].append(name)
+
+    with bakers.app.app_context():
+        start = date.today() - timedelta(days=365 * args.years)
+        rows_imported = 0
+        for account in accounts:
+            lines = ['date,item,quantity']
+            day = start
+            while day < date.today():
+                for item in rng.sample(account['items'], min(3, len(account['items']))):
+                    lines.append(f"{day.isoformat()},{item},{rng.randint(1, 20)}")
+                day += timedelta(days=1)
+            with bakers.use_business(account['business_id']):
+                summary = bakers.import_sales(io.StringIO('\n'.join(lines) + '\n'), 'csv', account['user_id'], account['business_id'])
+                # Generous stock for the current week so benchmark sales are never rejected
+                bakers.populate_user_data(account['user_id'], account['business_id'], year, month, week)
+                conn = bakers.get_db()
+                conn.execute("UPDATE inventory SET amount = 1000000000 WHERE year = ? AND month = ? AND week = ?", (year, month, week))
+                conn.commit()
+            rows_imported += summary['imported']
+    return accounts, ingredients, rows_imported
+
+def worker(client_factory, account, ingredients, iterations, results, errors, lock, rng):
+    year, month, week = account['period']
+    timings = {}
+    def timed(route, call):
+        started = time.perf_counter()
+        response = call()
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400 or response.headers.get('Location', '').startswith('/login'):
+            raise RuntimeError(f"{route} returned {response.status_code}")
+        timings.setdefault(route, []).append(elapsed)
+
+    client = client_factory()
+    try:
+        timed('POST /login', lambda: client.post('/login', data={'username': account['username'], 'password': PASSWORD,
+                                                                 'business_id': account['business_id']}))
+        for i in range(iterations):
+            timed('GET /', lambda: client.get('/'))
+            sale = {item: rng.randint(0, 2) for item in rng.sample(account['items'], min(3, len(account['items'])))}
+            timed('POST /sales', lambda: client.post('/sales', data={'year': year, **sale}))
+            period = ('weekly', 'monthly', 'yearly')[i % 3]
+            timed('GET /sales_report', lambda: client.get(f'/sales_report/{period}?year={date.today().year}'))
+            if account['role'] == 'admin' and i % 5 == 0:
+                timed('GET /update_inventory', lambda: client.get(f'/update_inventory?year={year}&month={month}&week={week}'))
+                stock = {ingredient: 1000000000 for ingredient in ingredients}
+                timed('POST /update_inventory', lambda: client.post('/update_inventory', data={'year': year, 'month': month, 'week': week, **stock}))
+    except Exception as e:
+        # A failed request ends the thread; main() reports it and fails the run
+        with lock:
+            errors.append(f"{account['username']}: {e}")
+    finally:
+        with lock:
+            for route, samples in timings.items():
+                results.setdefault(route, []).extend(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--businesses', type=int, default=2)
+    parser.add_argument('--users', type=int, default=3, help='Users per business; the first is an admin.')
+    parser.add_argument('--recipes', type=int, default=5, help='Extra recipes per admin on top of the three defaults.')
+    parser.add_argument('--years', type=int, default=1, help='Years of daily sales history per user.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=25, help='Workload loops per thread.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-p95', type=float, help='Fail if any route p95 exceeds this many milliseconds.')
+    args = parser.parse_args()
+
+    os.environ['BAKERS_DB_NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.setdefault('BAKERS_DB_POOL_SIZE', str(max(5, args.threads)))
+    os.environ.setdefault('BAKERS_LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as bakers
+    bakers.app.config['TESTING'] = True
+
+    started = time.perf_counter()
+    accounts, ingredients, rows_imported = seed(bakers, bakers.app.test_client, args)
+    print(f"Seeded {args.businesses} businesses, {len(accounts)} users and {rows_imported} sales rows "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    period = bakers.get_current_period()
+    for account in accounts:
+        account['period'] = period
+    results, errors, lock = {}, [], threading.Lock()
+    threads = [threading.Thread(target=worker, args=(bakers.app.test_client, accounts[i % len(accounts)], ingredients,
+                                                     args.iterations, results, errors, lock, random.Random(args.seed + i)))
+               for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(samples) for samples in results.values())
+    print(f"\n{'route':<24} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    failed = []
+    for route, samples in sorted(results.items()):
+        p50, p95, p99 = (percentile(samples, pct) * 1000 for pct in (50, 95, 99))
+        print(f"{route:<24} {len(samples):>6} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {max(samples) * 1000:>8.2f}")
+        if args.max_p95 is not None and p95 > args.max_p95:
+            failed.append(route)
+    print(f"\n{total} requests in {elapsed:.2f}s with {args.threads} threads: {total / elapsed:.1f} req/s")
+    for error in errors:
+        print(f"Worker failed: {error}")
+    if failed:
+        print(f"p95 above {args.max_p95}ms: {', '.join(failed)}")
+    if failed or errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Checks that inventory_snapshots stays flat as sales accumulate.
+
+Records sales against a throwaway database and, every --step sales, prints
+the snapshot row count and the median latency of the opening/closing
+snapshot lookups used by the home page.
+
+    python benchmarks/snapshot_growth.py --sales 5000 --step 1000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sales', type=int, default=5000)
+    parser.add_argument('--step', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ['BAKERS_DB_NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as bakers
+
+    with bakers.app.app_context():
+        bakers.init_db()
+        year, month, week = bakers.get_current_period()
+        bakers.populate_user_data(1, 1, year, month, week)
+        conn = bakers.get_db()
+        # Plenty of stock so no sale is rejected
+        conn.execute("UPDATE inventory SET amount = 1000000000 WHERE business_id = 1")
+        conn.commit()
+        daily_sales = {'Bread': 1, 'Cake': 1}
+        total_ingredients = bakers.compute_ingredients(daily_sales, 1)
+
+        print(f"{'sales':>8} {'snapshot rows':>14} {'opening ms':>11} {'closing ms':>11}")
+        for n in range(1, args.sales + 1):
+            bakers.record_sale(daily_sales, total_ingredients, 1, 1, year, month, week)
+            if n % args.step:
+                continue
+            rows = conn.execute("SELECT COUNT(*) FROM inventory_snapshots").fetchone()[0]
+            timings = {}
+            for snapshot_type in ('opening', 'closing'):
+                samples = []
+                for _ in range(args.lookups):
+                    started = time.perf_counter()
+                    bakers.get_opening_closing_inventory(1, year, 'week', week, snapshot_type)
+                    samples.append((time.perf_counter() - started) * 1000)
+                timings[snapshot_type] = statistics.median(samples)
+            print(f"{n:>8} {rows:>14} {timings['opening']:>11.3f} {timings['closing']:>11.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Multi-tenant write throughput: one shared database vs per-business shards.
+
+Runs one writer process per business, each recording --sales sales for its
+own business through record_sale, first with every business in a single
+database file and then with SHARD_DIR set so each business has its own file.
+Prints sales/s for both layouts; with shards the writers no longer queue on
+one SQLite write lock, so throughput should grow with --businesses.
+
+    python benchmarks/tenant_writes.py --businesses 1 2 4 8 --sales 500
+
+Background jobs are left queued (JOB_WORKERS=0) so only the sale
+transaction itself is measured.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_app(db_name, shard_dir):
+    os.environ['BAKERS_DB_NAME'] = db_name
+    os.environ['BAKERS_SHARD_DIR'] = shard_dir
+    os.environ['BAKERS_JOB_WORKERS'] = '0'
+    os.environ['BAKERS_JOB_MAX_PENDING'] = str(10 ** 9)
+    os.environ.setdefault('BAKERS_LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import app as bakers
+    return bakers
+
+def seed(db_name, shard_dir, businesses):
+    bakers = load_app(db_name, shard_dir)
+    with bakers.app.app_context():
+        bakers.init_db()
+        conn = bakers.get_directory_db()
+        for b in range(1, businesses):
+            conn.execute("INSERT INTO businesses (name) VALUES (?)", (f"Tenant Bakery {b}",))
+        conn.commit()
+        accounts = []
+        for business_id in sorted(bakers.get_businesses()):
+            conn.execute("INSERT OR IGNORE INTO users (username, password, role, business_id) VALUES ('writer', '', 'user', ?)", (business_id,))
+            conn.commit()
+            user_id = conn.execute("SELECT id FROM users WHERE username = 'writer' AND business_id = ?", (business_id,)).fetchone()[0]
+            with bakers.use_business(business_id):
+                bakers.populate_user_data(user_id, business_id)
+                # Plenty of stock so no sale is rejected
+                tenant = bakers.get_db()
+                tenant.execute("UPDATE inventory SET amount = 1000000000 WHERE business_id = ?", (business_id,))
+                tenant.commit()
+            accounts.append((business_id, user_id))
+    return accounts
+
+def writer(db_name, shard_dir, business_id, user_id, sales, start, results):
+    bakers = load_app(db_name, shard_dir)
+    year, month, week = bakers.get_current_period()
+    with bakers.app.app_context(), bakers.use_business(business_id):
+        daily_sales = {'Bread': 1, 'Cake': 1}
+        total_ingredients = bakers.compute_ingredients(daily_sales, user_id)
+        start.wait()
+        for _ in range(sales):
+            insufficient, _, _ = bakers.record_sale(daily_sales, total_ingredients, user_id, business_id, year, month, week)
+            if insufficient:
+                raise RuntimeError(f"Sale rejected for business {business_id}: {insufficient}")
+        results.put(business_id)
+
+def run(businesses, sales, sharded):
+    workdir = tempfile.mkdtemp()
+    db_name = os.path.join(workdir, 'bench.db')
+    shard_dir = os.path.join(workdir, 'shards') if sharded else ''
+    if shard_dir:
+        os.makedirs(shard_dir)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        accounts = pool.apply(seed, (db_name, shard_dir, businesses))
+    start, results = ctx.Event(), ctx.Queue()
+    processes = [ctx.Process(target=writer, args=(db_name, shard_dir, business_id, user_id, sales, start, results))
+                 for business_id, user_id in accounts]
+    for process in processes:
+        process.start()
+    # Give every writer time to import the app before the clock starts
+    time.sleep(2)
+    started = time.perf_counter()
+    start.set()
+    for _ in processes:
+        # A writer that dies never reports, so do not wait on it forever
+        results.get(timeout=600)
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f"Writer process failed with exit code {process.exitcode}")
+    return len(processes) * sales / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--businesses', type=int, nargs='+', default=[1, 2, 4], help='Concurrent tenants to try, one writer each.')
+    parser.add_argument('--sales', type=int, default=300, help='Sales per writer.')
+    args = parser.parse_args()
+
+    print(f"{'businesses':>10} {'shared sales/s':>15} {'sharded sales/s':>16} {'speedup':>8}")
+    for businesses in args.businesses:
+        shared = run(businesses, args.sales, sharded=False)
+        sharded = run(businesses, args.sales, sharded=True)
+        print(f"{businesses:>10} {shared:>15.1f} {sharded:>16.1f} {sharded / shared:>7.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from queue import LifoQueue, Empty, Full
+
+# Pragmas applied to every pooled connection. WAL lets readers run while a
+# sale is being written; busy_timeout makes writers wait for the lock instead
+# of failing straight away with "database is locked".
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+class ConnectionPool:
+    def __init__(self, database, size=5, pragmas=None, timeout=30, cached_statements=256, factory=sqlite3.Connection):
+        self.database = database
+        self.factory = factory
+        self.size = size
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections move between worker threads, so same-thread checking is
+        # disabled; the pool guarantees only one thread holds a connection.
+        # cached_statements keeps prepared statements around for reuse.
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=self.factory)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # Pool exhausted: wait for another request to hand a connection back
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            raise sqlite3.OperationalError(f"Timed out waiting for a connection to {self.database}")
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+@contextmanager
+def transaction(conn, immediate=True):
+    # BEGIN IMMEDIATE takes the write lock up front so two registers cannot
+    # both pass the stock check and then both decrement. Nested use simply
+    # joins the transaction that is already open.
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+@contextmanager
+def savepoint(conn, name='unit'):
+    # A unit of work inside an open transaction that can fail on its own:
+    # its writes are undone and the error re-raised, while the enclosing
+    # transaction carries on
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    conn.execute(f"RELEASE {name}")
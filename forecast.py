@@ -0,0 +1,54 @@
+import math
+from datetime import date
+
+# Weekly demand forecasts from daily sales history. The forecast for the
+# coming week is the mean of the last `window` weeks, scaled by how the same
+# week last year compared with the weeks before it when that history exists.
+
+SEASON_WEEKS = 52
+SEASONAL_RANGE = (0.5, 2.0)
+
+def history_days(window):
+    # Days of history forecast_items looks at, for bounding the sales query
+    return 7 * (SEASON_WEEKS + window)
+
+def forecast_items(rows, week_start, window=4, seasonal=True):
+    # rows are (key, 'YYYY-MM-DD', quantity) daily sales, in any order.
+    # Returns {key: forecast quantity} for the 7 days starting at week_start.
+    # Weeks are counted back from week_start: week 0 is the week before it.
+    recent = {}
+    last_year = {}
+    for key, day, quantity in rows:
+        age = (week_start - date.fromisoformat(day)).days - 1
+        if age < 0:
+            continue
+        weeks_ago = age // 7
+        if weeks_ago < window:
+            recent.setdefault(key, [0] * window)[weeks_ago] += quantity
+        elif seasonal and SEASON_WEEKS - 1 <= weeks_ago < SEASON_WEEKS + window:
+            # Week SEASON_WEEKS - 1 is the coming week a year ago; the `window`
+            # weeks after it in age are its own baseline
+            last_year.setdefault(key, [0] * (window + 1))[weeks_ago - SEASON_WEEKS + 1] += quantity
+    forecasts = {}
+    for key, weeks in recent.items():
+        forecast = sum(weeks) / window
+        season = last_year.get(key)
+        if season is not None:
+            baseline = sum(season[1:]) / window
+            if baseline > 0 and season[0] > 0:
+                low, high = SEASONAL_RANGE
+                forecast *= min(high, max(low, season[0] / baseline))
+        forecasts[key] = forecast
+    return forecasts
+
+def reorder_list(demand, inventory, safety=0.1):
+    # Ingredients whose forecast demand plus a safety margin exceeds what is
+    # on hand, with the amount to order, largest orders first
+    rows = []
+    for ingredient, needed in demand.items():
+        needed = math.ceil(needed)
+        on_hand = inventory.get(ingredient, 0)
+        reorder = max(0, math.ceil(needed * (1 + safety)) - on_hand)
+        rows.append({'ingredient': ingredient, 'demand': needed, 'on_hand': on_hand, 'reorder': reorder})
+    rows.sort(key=lambda row: (-row['reorder'], row['ingredient']))
+    return rows
@@ -0,0 +1,158 @@
+import cProfile
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+from app_logging import logger
+
+SLOWEST_PER_REQUEST = 5
+
+# Only one cProfile profiler can be active per process (Python 3.12+ raises
+# ValueError otherwise), so a sampled request skips profiling while another runs
+_profile_lock = threading.Lock()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Passed as the sqlite3.connect factory so every statement goes through InstrumentedCursor
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class Metrics:
+    def __init__(self, slowest=10):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.sql = {}
+        self.slowest_limit = slowest
+        self.slowest = {}
+
+    def observe_request(self, endpoint, method, status, seconds, queries, sql_seconds, slowest):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            total, count = self.durations.get(endpoint, (0.0, 0))
+            self.durations[endpoint] = (total + seconds, count + 1)
+            total_queries, total_sql = self.sql.get(endpoint, (0, 0.0))
+            self.sql[endpoint] = (total_queries + queries, total_sql + sql_seconds)
+            for statement_seconds, sql in slowest:
+                if statement_seconds > self.slowest.get(sql, 0.0):
+                    self.slowest[sql] = statement_seconds
+            if len(self.slowest) > self.slowest_limit:
+                keep = sorted(self.slowest.items(), key=lambda item: item[1], reverse=True)[:self.slowest_limit]
+                self.slowest = dict(keep)
+
+    def render(self, caches=None):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            lines += ['# HELP bakers_requests_total HTTP requests handled.', '# TYPE bakers_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'bakers_requests_total{{endpoint="{escape(endpoint)}",method="{method}",status="{status}"}} {count}')
+            lines += ['# HELP bakers_request_duration_seconds Wall time spent handling requests.', '# TYPE bakers_request_duration_seconds summary']
+            for endpoint, (total, count) in sorted(self.durations.items()):
+                lines.append(f'bakers_request_duration_seconds_sum{{endpoint="{escape(endpoint)}"}} {total:.6f}')
+                lines.append(f'bakers_request_duration_seconds_count{{endpoint="{escape(endpoint)}"}} {count}')
+            lines += ['# HELP bakers_sql_queries_total SQL statements executed while handling requests.', '# TYPE bakers_sql_queries_total counter']
+            for endpoint, (queries, _) in sorted(self.sql.items()):
+                lines.append(f'bakers_sql_queries_total{{endpoint="{escape(endpoint)}"}} {queries}')
+            lines += ['# HELP bakers_sql_duration_seconds_total Time spent in SQL while handling requests.', '# TYPE bakers_sql_duration_seconds_total counter']
+            for endpoint, (_, seconds) in sorted(self.sql.items()):
+                lines.append(f'bakers_sql_duration_seconds_total{{endpoint="{escape(endpoint)}"}} {seconds:.6f}')
+            lines += ['# HELP bakers_sql_slowest_seconds Slowest observed run of the slowest statements.', '# TYPE bakers_sql_slowest_seconds gauge']
+            for sql, seconds in sorted(self.slowest.items(), key=lambda item: item[1], reverse=True):
+                lines.append(f'bakers_sql_slowest_seconds{{statement="{escape(sql)}"}} {seconds:.6f}')
+        for name, stats in sorted((caches or {}).items()):
+            for metric, value in (('hits', stats['hits']), ('misses', stats['misses']), ('evictions', stats['evictions'])):
+                lines.append(f'bakers_cache_{metric}_total{{cache="{name}"}} {value}')
+            lines.append(f'bakers_cache_size{{cache="{name}"}} {stats["size"]}')
+        return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return ' '.join(str(value).split()).replace('\\', '\\\\').replace('"', '\\"')
+
+metrics = Metrics()
+
+def record_query(sql, seconds):
+    if not has_request_context() or 'sql_stats' not in g:
+        return
+    stats = g.sql_stats
+    stats['count'] += 1
+    stats['seconds'] += seconds
+    stats['slowest'].append((seconds, sql))
+    if len(stats['slowest']) > SLOWEST_PER_REQUEST:
+        stats['slowest'].sort(reverse=True)
+        del stats['slowest'][SLOWEST_PER_REQUEST:]
+
+def init_instrumentation(app):
+    # Opt-in per-request wall time, SQL count/time and sampled cProfile dumps
+    sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+    profile_dir = app.config.get('PROFILE_DIR', 'profiles')
+
+    @app.before_request
+    def start_instrumentation():
+        g.request_started = time.perf_counter()
+        g.sql_stats = {'count': 0, 'seconds': 0.0, 'slowest': []}
+        if sample_rate and random.random() < sample_rate and _profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            try:
+                g.profiler.enable()
+            except ValueError:
+                # Another profiler (a debugger, a benchmark harness) is already running
+                g.pop('profiler')
+                _profile_lock.release()
+
+    @app.after_request
+    def finish_instrumentation(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        stats = g.sql_stats
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe_request(endpoint, request.method, response.status_code, elapsed,
+                                stats['count'], stats['seconds'], stats['slowest'])
+        timing = f"sql;dur={stats['seconds'] * 1000:.2f};desc=\"{stats['count']} queries\", total;dur={elapsed * 1000:.2f}"
+        existing = response.headers.get('Server-Timing')
+        response.headers['Server-Timing'] = f"{existing}, {timing}" if existing else timing
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f"{endpoint}-{g.get('request_id', int(time.time() * 1000))}.prof")
+            profiler.dump_stats(path)
+            logger.info("Wrote profile for %s %s to %s", request.method, request.path, path)
+        logger.debug("%s %s took %.1fms with %s queries (%.1fms SQL)", request.method, request.path,
+                     elapsed * 1000, stats['count'], stats['seconds'] * 1000)
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exception):
+        # A request that failed before after_request still has to free the profiler
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
@@ -0,0 +1,161 @@
+import json
+import threading
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from app_logging import logger
+from db import transaction, savepoint
+
+JOBS_TABLE = '''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT, status TEXT,
+                  attempts INTEGER DEFAULT 0, error TEXT, created_at TEXT, finished_at TEXT)'''
+JOBS_INDEX = "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)"
+
+class QueueFull(Exception):
+    pass
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class JobQueue:
+    # Background jobs persisted in the jobs table and run by worker threads.
+    # enqueue() writes inside the caller's transaction, so a job exists exactly
+    # when the write that needs it committed, and queued jobs survive restarts.
+    # A job's handler runs in the same transaction that marks it done, so each
+    # job takes effect once. With workers=0 jobs only run through run_pending().
+    # Each database has its own jobs table: scopes() lists them and
+    # use_scope(scope) routes get_db() to one while its jobs run.
+
+    def __init__(self, app, get_db, workers=2, max_pending=1000, max_attempts=3, poll_interval=1.0, retention_hours=24,
+                 scopes=lambda: [None], use_scope=lambda scope: nullcontext()):
+        self.app = app
+        self.get_db = get_db
+        self.scopes = scopes
+        self.use_scope = use_scope
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retention_hours = retention_hours
+        self.handlers = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def handler(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def enqueue(self, c, kind, **payload):
+        # Raises QueueFull when max_pending jobs are already waiting, so the
+        # caller can do the work inline instead of growing the backlog
+        c.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'")
+        if c.fetchone()[0] >= self.max_pending:
+            raise QueueFull()
+        c.execute("INSERT INTO jobs (kind, payload, status, created_at) VALUES (?, ?, 'queued', ?)", (kind, json.dumps(payload), now()))
+        self.start()
+        self._wake.set()
+        return c.lastrowid
+
+    def start(self):
+        with self._lock:
+            if self._threads or not self.workers:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info("Started %s job workers", self.workers)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._stopping.clear()
+
+    def _work(self):
+        woken = False
+        while not self._stopping.is_set():
+            try:
+                if self.run_pending(wait_for_writers=woken):
+                    continue
+            except Exception:
+                logger.exception("Job worker failed to claim a job")
+            # Enqueuers wake the workers, but a job is only visible once its
+            # transaction commits, so idle workers also poll
+            woken = self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def run_pending(self, limit=None, wait_for_writers=False):
+        # Runs queued jobs in the calling thread; returns how many ran. With
+        # wait_for_writers every claim takes the write lock, so a job whose
+        # transaction is still committing is picked up rather than missed.
+        ran = 0
+        with self.app.app_context():
+            scopes = self.scopes()
+        for scope in scopes:
+            ran_here = 0
+            while (limit is None or ran < limit) and not self._stopping.is_set():
+                with self.app.app_context(), self.use_scope(scope):
+                    if not self._run_next(wait_for_writers):
+                        # Clear out old finished jobs once a backlog has drained
+                        if ran_here:
+                            self._prune()
+                        break
+                ran += 1
+                ran_here += 1
+        return ran
+
+    def _run_next(self, wait_for_writers=False):
+        conn = self.get_db()
+        c = conn.cursor()
+        if not wait_for_writers:
+            # Idle polls only read, so they never queue behind or block the
+            # sales writers; the write lock is taken once there is work to claim
+            c.execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1")
+            if not c.fetchall():
+                return False
+        with transaction(conn):
+            c.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1")
+            row = c.fetchone()
+            if row is None:
+                return False
+            job_id, kind, payload, attempts = row
+            try:
+                # A failed handler's writes are rolled back to here, and the
+                # failure is recorded before another worker can claim the job
+                with savepoint(conn, 'job'):
+                    self.handlers[kind](**json.loads(payload))
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job_id, kind)
+                status = 'failed' if attempts + 1 >= self.max_attempts else 'queued'
+                c.execute("UPDATE jobs SET attempts = ?, status = ?, error = ?, finished_at = ? WHERE id = ?",
+                          (attempts + 1, status, f"{type(e).__name__}: {e}", now(), job_id))
+            else:
+                c.execute("UPDATE jobs SET attempts = ?, status = 'done', error = NULL, finished_at = ? WHERE id = ?",
+                          (attempts + 1, now(), job_id))
+        return True
+
+    def _prune(self):
+        cutoff = (datetime.now() - timedelta(hours=self.retention_hours)).strftime('%Y-%m-%d %H:%M:%S')
+        conn = self.get_db()
+        with transaction(conn):
+            conn.cursor().execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (cutoff,))
+
+    def stats(self):
+        c = self.get_db().cursor()
+        c.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        counts = {'queued': 0, 'done': 0, 'failed': 0}
+        counts.update(c.fetchall())
+        return counts
+
+    def recent(self, limit=50):
+        c = self.get_db().cursor()
+        c.execute("SELECT id, kind, status, attempts, error, created_at, finished_at FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+        columns = ('id', 'kind', 'status', 'attempts', 'error', 'created_at', 'finished_at')
+        return [dict(zip(columns, row)) for row in c.fetchall()]
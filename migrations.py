@@ -0,0 +1,39 @@
+import sqlite3
+from datetime import datetime
+
+from db import transaction
+
+# Versioned schema migrations. A migration list holds (name, step) pairs and a
+# step's version is its position in the list, starting at 1; step(c) gets a
+# cursor inside the migration transaction. schema_version records what has
+# been applied, so an up-to-date database costs a single query to check.
+# Released steps are never edited or reordered, only appended to.
+
+SCHEMA_VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS schema_version
+                 (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT)'''
+
+def schema_version(c):
+    try:
+        c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except sqlite3.OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+        return 0
+    return c.fetchone()[0]
+
+def migrate(conn, migrations):
+    # Applies every pending step in one transaction and returns the version
+    # the database started at. BEGIN IMMEDIATE serialises processes starting
+    # together, and the version is re-read under the lock so each step runs once.
+    c = conn.cursor()
+    version = schema_version(c)
+    if version >= len(migrations):
+        return version
+    with transaction(conn):
+        c.execute(SCHEMA_VERSION_TABLE)
+        version = schema_version(c)
+        applied_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for number, (name, step) in enumerate(migrations[version:], start=version + 1):
+            step(c)
+            c.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (number, name, applied_at))
+    return version
@@ -0,0 +1,42 @@
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# ISO-week calendar. Inventory is kept per (year, month, week) where year and
+# week are the ISO year and week, and month is the month holding the week's
+# Thursday, so every week belongs to exactly one month.
+
+def week_start(year, week):
+    jan4 = date(year, 1, 4)
+    return jan4 - timedelta(days=jan4.weekday()) + timedelta(weeks=week - 1)
+
+@lru_cache(maxsize=64)
+def year_calendar(year):
+    # {week: (start, end, month)} for weeks 1-53; week 53 of a 52-week year
+    # spills into the next year, as the plain date arithmetic always did
+    calendar = {}
+    for week in range(1, 54):
+        start = week_start(year, week)
+        calendar[week] = (start.isoformat(), (start + timedelta(days=6)).isoformat(), (start + timedelta(days=3)).month)
+    return calendar
+
+def week_bounds(year, week):
+    # (start, end) dates of an ISO week as YYYY-MM-DD strings
+    entry = year_calendar(year).get(week)
+    if entry is None:
+        start = week_start(year, week)
+        return start.isoformat(), (start + timedelta(days=6)).isoformat()
+    return entry[0], entry[1]
+
+def week_month(year, week):
+    entry = year_calendar(year).get(week)
+    if entry is None:
+        return (week_start(year, week) + timedelta(days=3)).month
+    return entry[2]
+
+def period_for_date(day):
+    # (year, month, week) inventory period a date falls into
+    iso_year, week, _ = day.isocalendar()
+    return iso_year, week_month(iso_year, week), week
+
+def current_period():
+    return period_for_date(datetime.now().date())
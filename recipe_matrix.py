@@ -0,0 +1,56 @@
+class RecipeMatrix:
+    # Recipes as a sparse items x ingredients matrix. Sales (or production
+    # plans) are vectors over items, so ingredient requirements for many of
+    # them at once are a single vector-matrix product per row. Only non-zero
+    # amounts are stored, so a recipe costs what it uses, not the size of the
+    # ingredient dictionary.
+
+    def __init__(self, recipes):
+        self.items = list(recipes)
+        self.ingredients = []
+        self.ingredient_index = {}
+        self.item_index = {item: i for i, item in enumerate(self.items)}
+        self._nonzero = []
+        for item in self.items:
+            row = []
+            for ingredient, amount in recipes[item].items():
+                if amount <= 0:
+                    continue
+                j = self.ingredient_index.get(ingredient)
+                if j is None:
+                    j = self.ingredient_index[ingredient] = len(self.ingredients)
+                    self.ingredients.append(ingredient)
+                row.append((j, amount))
+            self._nonzero.append(row)
+
+    def vector(self, sales):
+        # Item quantities in matrix order; unknown items and non-positive quantities are ignored
+        vec = [0] * len(self.items)
+        for item, quantity in sales.items():
+            i = self.item_index.get(item)
+            if i is not None and quantity > 0:
+                vec[i] += quantity
+        return vec
+
+    def multiply(self, vectors):
+        results = []
+        for vec in vectors:
+            totals = [0] * len(self.ingredients)
+            for i, quantity in enumerate(vec):
+                if quantity:
+                    for j, amount in self._nonzero[i]:
+                        totals[j] += amount * quantity
+            results.append(totals)
+        return results
+
+    def requirements(self, sales):
+        return self.batch_requirements([sales])[0]
+
+    def batch_requirements(self, scenarios):
+        totals = self.multiply([self.vector(sales) for sales in scenarios])
+        return [{ingredient: amount for ingredient, amount in zip(self.ingredients, row) if amount > 0} for row in totals]
+
+    @staticmethod
+    def shortfalls(requirements, inventory):
+        return {ingredient: amount - inventory.get(ingredient, 0)
+                for ingredient, amount in requirements.items() if amount > inventory.get(ingredient, 0)}
@@ -0,0 +1,54 @@
+import csv
+import json
+from io import StringIO
+
+# Download formats and their content types; 'txt' is the layout shown on the report pages
+REPORT_FORMATS = {'txt': 'text/plain', 'csv': 'text/csv', 'json': 'application/json'}
+
+# Daily reports are dicts of year, month, week, used {ingredient: amount},
+# inventory {ingredient: amount}, alerts [message] and an optional title for
+# the used section. Sales reports are dicts of period, year, title,
+# items [(item, quantity)] and total.
+
+def render_daily_report(report, fmt='txt'):
+    if fmt == 'json':
+        return json.dumps(report)
+    out = StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['section', 'name', 'amount'])
+        writer.writerows(('used', ingredient, amount) for ingredient, amount in report['used'].items())
+        writer.writerows(('remaining', ingredient, amount) for ingredient, amount in report['inventory'].items())
+        writer.writerows(('alert', alert, '') for alert in report['alerts'])
+        return out.getvalue()
+    out.write(f"{report.get('title', 'Total Ingredients Used Today')}:\n")
+    for ingredient, amount in report['used'].items():
+        out.write(f"{ingredient}: {amount} units\n")
+    if not report['used']:
+        out.write("No items were sold today.\n")
+    out.write(f"\nRemaining Inventory for Year {report['year']}, Month {report['month']}, Week {report['week']}:\n")
+    for ingredient, amount in report['inventory'].items():
+        out.write(f"{ingredient}: {amount} units\n")
+    if report['alerts']:
+        out.write("\nInventory Alerts:\n")
+        for alert in report['alerts']:
+            out.write(f"{alert}\n")
+    return out.getvalue()
+
+def render_sales_report(report, fmt='txt'):
+    if fmt == 'json':
+        return json.dumps({**report, 'items': [{'item': item, 'quantity': quantity} for item, quantity in report['items']]})
+    out = StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['item', 'quantity'])
+        writer.writerows(report['items'])
+        return out.getvalue()
+    out.write(f"{report['title']}:\n")
+    for item, quantity in report['items']:
+        out.write(f"{item}: {quantity} units\n")
+    if not report['items']:
+        out.write("No sales recorded.\n")
+    else:
+        out.write(f"\nTotal Items Sold: {report['total']} units\n")
+    return out.getvalue()
@@ -0,0 +1,90 @@
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+from periods import week_month
+
+FORMATS = ('csv', 'jsonl')
+
+def detect_format(filename, default='csv'):
+    name = (filename or '').lower()
+    if name.endswith('.jsonl') or name.endswith('.ndjson'):
+        return 'jsonl'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+def iter_rows(stream, fmt):
+    # Yields (line_number, row) from a text stream without reading it all into memory
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row
+    else:
+        raise ValueError(f"Unsupported format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+def parse_sale(row):
+    # Returns (date, item, quantity, year) or raises ValueError with the reason
+    if not isinstance(row, dict):
+        raise ValueError('malformed row')
+    try:
+        date = datetime.strptime(str(row.get('date', '')).strip(), '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"invalid date {row.get('date')!r}")
+    item = str(row.get('item') or '').strip()
+    if not item:
+        raise ValueError('missing item')
+    try:
+        quantity = int(row.get('quantity'))
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid quantity {row.get('quantity')!r}")
+    if quantity <= 0:
+        raise ValueError(f"invalid quantity {quantity}")
+    year = row.get('year')
+    try:
+        year = int(year) if year not in (None, '') else date.year
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid year {year!r}")
+    return date, item, quantity, year
+
+def parse_delivery(row):
+    # Delivery manifest row: returns (year, month, week, ingredient, amount) or
+    # raises ValueError. month is optional and derived from the ISO week.
+    if not isinstance(row, dict):
+        raise ValueError('malformed row')
+    values = {}
+    for field in ('year', 'week', 'amount'):
+        try:
+            values[field] = int(row.get(field))
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid {field} {row.get(field)!r}")
+    if not 1 <= values['week'] <= 53:
+        raise ValueError(f"invalid week {values['week']}")
+    if values['amount'] <= 0:
+        raise ValueError(f"invalid amount {values['amount']}")
+    ingredient = str(row.get('ingredient') or '').strip()
+    if not ingredient:
+        raise ValueError('missing ingredient')
+    month = week_month(values['year'], values['week'])
+    if row.get('month') not in (None, '') and str(row.get('month')).strip() != str(month):
+        raise ValueError(f"week {values['week']} of {values['year']} belongs to month {month}, not {row.get('month')}")
+    return values['year'], month, values['week'], ingredient, values['amount']
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk